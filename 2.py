@@ -1,13 +1,56 @@
+import argparse
+import asyncio
 import socket
 import threading
 import json
+import math
+import random
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import common
 
 HOST = '127.0.0.1'
 PORT = 65432
 
+# Numbers up to SIEVE_LIMIT are answered from a bitmap built at startup
+SIEVE_LIMIT = 10**8
+# Maximum number of results kept by the shared LRU cache
+CACHE_SIZE = 100_000
+# Numbers wider than this are checked in an executor / process pool, per
+# engine: trial division of a 64-bit semiprime would block for minutes
+INLINE_MAX_BITS = {
+    "trial": 32,
+    "miller-rabin": 64,
+    "bpsw": 64,
+}
+# Requests longer than this are malformed
+MAX_LINE_LENGTH = 1 << 20
 
-def is_prime(n):
-    """Check if an integer is prime."""
+# Deterministic Miller-Rabin witnesses, valid for every n < 2**64
+MR_BASES_64 = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+# Random rounds used by the "miller-rabin" engine above 2**64
+MR_ROUNDS = 20
+
+
+def sieve_primes(limit):
+    """Returns all primes <= limit (sieve of Eratosthenes)."""
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[0:2] = b'\x00\x00'
+    for i in range(2, math.isqrt(limit) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit + 1, i)))
+    return [i for i, flag in enumerate(sieve) if flag]
+
+
+SMALL_PRIMES = sieve_primes(1000)
+SMALL_PRIME_SET = frozenset(SMALL_PRIMES)
+SMALL_PRIME_LIMIT = SMALL_PRIMES[-1]
+
+
+def is_prime_trial(n):
+    """Check if an integer is prime by trial division (reference engine)."""
     if not isinstance(n, int):
         return False
     if n <= 1:
@@ -18,28 +61,290 @@ def is_prime(n):
     return True
 
 
+def small_prime_filter(n):
+    """
+    Cheap pre-filter using trial division by the small primes.
+    Returns True/False when it settles the answer, None otherwise.
+    """
+    if n <= SMALL_PRIME_LIMIT:
+        return n in SMALL_PRIME_SET
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return False
+    if n < SMALL_PRIME_LIMIT * SMALL_PRIME_LIMIT:
+        return True
+    return None
+
+
+def is_strong_probable_prime(n, a):
+    """Single Miller-Rabin round: is odd n > 2 a strong probable prime to base a?"""
+    a %= n
+    if a == 0:
+        return True
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    x = pow(a, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = x * x % n
+        if x == n - 1:
+            return True
+    return False
+
+
+def jacobi(a, n):
+    """Jacobi symbol (a/n) for odd positive n."""
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def is_strong_lucas_probable_prime(n):
+    """Strong Lucas test with Selfridge's parameters, for odd n > 2."""
+    root = math.isqrt(n)
+    if root * root == n:
+        return False
+
+    D = 5
+    while True:
+        j = jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D) // 4
+
+    d = n + 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    # Binary Lucas chain computing U_d, V_d and Q**d (mod n)
+    U, V, Qk = 0, 2, 1
+    for bit in bin(d)[2:]:
+        U = U * V % n
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == '1':
+            U, V = P * U + V, D * U + P * V
+            if U % 2:
+                U += n
+            if V % 2:
+                V += n
+            U = (U // 2) % n
+            V = (V // 2) % n
+            Qk = Qk * Q % n
+
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+
+
+def is_prime_miller_rabin(n):
+    """
+    Miller-Rabin engine: deterministic below 2**64, MR_ROUNDS random
+    bases above it.
+    """
+    if not isinstance(n, int) or n <= 1:
+        return False
+    settled = small_prime_filter(n)
+    if settled is not None:
+        return settled
+    if n < 1 << 64:
+        return all(is_strong_probable_prime(n, a) for a in MR_BASES_64)
+    bases = [2] + [random.randrange(3, n - 1) for _ in range(MR_ROUNDS - 1)]
+    return all(is_strong_probable_prime(n, a) for a in bases)
+
+
+def is_prime_bpsw(n):
+    """
+    Baillie-PSW engine: deterministic Miller-Rabin below 2**64, base-2
+    Miller-Rabin plus a strong Lucas test above it.
+    """
+    if not isinstance(n, int) or n <= 1:
+        return False
+    settled = small_prime_filter(n)
+    if settled is not None:
+        return settled
+    if n < 1 << 64:
+        return all(is_strong_probable_prime(n, a) for a in MR_BASES_64)
+    return is_strong_probable_prime(n, 2) and is_strong_lucas_probable_prime(n)
+
+
+PRIMALITY_ENGINES = {
+    "trial": is_prime_trial,
+    "miller-rabin": is_prime_miller_rabin,
+    "bpsw": is_prime_bpsw,
+}
+primality_engine = is_prime_bpsw
+inline_max_bits = INLINE_MAX_BITS["bpsw"]
+
+
+class PrimeSieve:
+    """Bit-packed sieve over the odd numbers up to limit (one bit each)."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        size = limit // 2 + 1  # index i stands for 2*i + 1
+        flags = bytearray([1]) * size
+        flags[0] = 0
+        for i in range(1, (math.isqrt(limit) - 1) // 2 + 1):
+            if flags[i]:
+                p = 2 * i + 1
+                start = p * p // 2
+                flags[start::p] = bytes(len(range(start, size, p)))
+
+        # Pack eight flag bytes into one: every flag is 0 or 1, so
+        # shifting whole strided slices never carries into a neighbour.
+        flags += bytes(-size % 8)
+        packed = 0
+        for bit in range(8):
+            packed |= int.from_bytes(flags[bit::8], 'little') << bit
+        self.bits = packed.to_bytes(len(flags) // 8, 'little')
+
+    def is_prime(self, n):
+        """Answers for any n <= limit."""
+        if n < 3:
+            return n == 2
+        if n % 2 == 0:
+            return False
+        i = n >> 1
+        return bool(self.bits[i >> 3] >> (i & 7) & 1)
+
+
+class PrimeCache:
+    """Thread-safe LRU cache of primality results with hit/miss counters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, n):
+        """Returns the cached result for n, or None."""
+        with self.lock:
+            result = self.results.get(n)
+            if result is None:
+                self.misses += 1
+                return None
+            self.results.move_to_end(n)
+            self.hits += 1
+            return result
+
+    def put(self, n, result):
+        with self.lock:
+            self.results[n] = result
+            self.results.move_to_end(n)
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.results),
+                "maxsize": self.maxsize,
+            }
+
+
+prime_sieve = None
+prime_cache = PrimeCache(CACHE_SIZE)
+
+
+def build_sieve(limit=SIEVE_LIMIT):
+    """Builds the shared sieve; call once at startup."""
+    global prime_sieve
+    prime_sieve = PrimeSieve(limit)
+    return prime_sieve
+
+
+def set_primality_engine(name):
+    """Selects the engine used by is_prime (one of PRIMALITY_ENGINES)."""
+    global primality_engine, inline_max_bits
+    if name not in PRIMALITY_ENGINES:
+        raise ValueError(f"Unknown primality engine: {name}")
+    primality_engine = PRIMALITY_ENGINES[name]
+    inline_max_bits = INLINE_MAX_BITS[name]
+    prime_cache.clear()
+
+
+def is_prime(n):
+    """Check if an integer is prime."""
+    if not isinstance(n, int):
+        return False
+    if prime_sieve is not None and n <= prime_sieve.limit:
+        return prime_sieve.is_prime(n)
+
+    result = prime_cache.get(n)
+    if result is None:
+        result = primality_engine(n)
+        prime_cache.put(n, result)
+    return result
+
+
+def decode_request(line):
+    """
+    Validates a single line JSON request.
+    Returns the integer to test, or None for a number that cannot be
+    prime (non-integral float). Raises ValueError if malformed.
+    """
+    request = json.loads(line)
+
+    # Basic format checks
+    if not isinstance(request, dict):
+        raise ValueError
+    if request.get("method") != "isPrime" or "number" not in request:
+        raise ValueError
+
+    number = request["number"]
+
+    if isinstance(number, float) and not number.is_integer():
+        return None
+    elif isinstance(number, (int, float)):
+        return int(number)
+    else:
+        raise ValueError
+
+
 def parse_request(line):
     """
     Parses a single line JSON request.
     Returns (valid: bool, response: dict).
     """
     try:
-        request = json.loads(line)
-
-        # Basic format checks
-        if not isinstance(request, dict):
-            raise ValueError
-        if request.get("method") != "isPrime" or "number" not in request:
-            raise ValueError
-
-        number = request["number"]
-
-        if isinstance(number, float) and not number.is_integer():
-            prime_result = False
-        elif isinstance(number, (int, float)):
-            prime_result = is_prime(int(number))
-        else:
-            raise ValueError
+        number = decode_request(line)
+        prime_result = number is not None and is_prime(number)
 
         response = {
             "method": "isPrime",
@@ -51,28 +356,139 @@ def parse_request(line):
         return False, {"malformed": True}
 
 
+PRIME_RESPONSE = (json.dumps({"method": "isPrime", "prime": True}) + '\n').encode()
+NOT_PRIME_RESPONSE = (json.dumps({"method": "isPrime", "prime": False}) + '\n').encode()
+MALFORMED_RESPONSE = (json.dumps({"malformed": True}) + '\n').encode()
+
+
+def encode_result(prime_result):
+    return PRIME_RESPONSE if prime_result else NOT_PRIME_RESPONSE
+
+
+def is_cheap(n):
+    """True if is_prime(n) can be answered without blocking for long."""
+    if prime_sieve is not None and n <= prime_sieve.limit:
+        return True
+    return n.bit_length() <= inline_max_bits or n in prime_cache.results
+
+
+def dispatch_lines(lines, submit=None):
+    """
+    Answers a batch of request lines in order, stopping at the first
+    malformed one. Cheap numbers are answered inline; the rest go to
+    submit(n), which returns a future, or inline when submit is None.
+    Returns (responses, malformed) where each response is bytes or a
+    (number, future) pair.
+    """
+    responses = []
+    malformed = False
+
+    for line in lines:
+        try:
+            number = decode_request(line)
+        except Exception:
+            responses.append(MALFORMED_RESPONSE)
+            malformed = True
+            break
+
+        if number is None:
+            responses.append(NOT_PRIME_RESPONSE)
+        elif submit is None or is_cheap(number):
+            responses.append(encode_result(is_prime(number)))
+        else:
+            responses.append((number, submit(number)))
+    return responses, malformed
+
+
+def answer_lines_blocking(lines, pool=None):
+    """Like answer_lines, for the threaded server; pool is an optional executor."""
+    submit = None if pool is None else (lambda n: pool.submit(is_prime, n))
+    responses, malformed = dispatch_lines(lines, submit)
+
+    for i, response in enumerate(responses):
+        if isinstance(response, tuple):
+            number, future = response
+            prime_result = future.result()
+            prime_cache.put(number, prime_result)
+            responses[i] = encode_result(prime_result)
+    return b''.join(responses), malformed
+
+
+async def answer_lines(lines, executor=None):
+    """
+    Answers a batch of request lines in order, offloading expensive
+    numbers to executor (the loop's default one when None).
+    Returns (responses: bytes, malformed: bool).
+    """
+    loop = asyncio.get_running_loop()
+    submit = lambda n: loop.run_in_executor(executor, is_prime, n)
+    responses, malformed = dispatch_lines(lines, submit)
+
+    for i, response in enumerate(responses):
+        if isinstance(response, tuple):
+            number, future = response
+            prime_result = await future
+            prime_cache.put(number, prime_result)
+            responses[i] = encode_result(prime_result)
+    return b''.join(responses), malformed
+
+
+# Optional pool of worker processes for expensive checks
+process_pool = None
+
+
+def start_process_pool(workers, engine="bpsw"):
+    """
+    Starts the shared process pool. Workers are spawned rather than
+    forked so they don't inherit the listening socket or the sieve.
+    """
+    global process_pool
+    process_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=set_primality_engine,
+        initargs=(engine,),
+    )
+    return process_pool
+
+
+class LineReader(common.LineReader):
+    """
+    common.LineReader, except that a complete line longer than max_line
+    comes back empty, so it is answered as malformed in order.
+    """
+
+    def feed(self, data):
+        buffered = len(self.pending) + len(data)
+        lines = super().feed(data)
+        if buffered > self.max_line:
+            lines = [b'' if len(line) > self.max_line else line for line in lines]
+        return lines
+
+
 def handle_client(conn, addr):
     """Handles an individual client connection."""
     print(f"Connected by {addr}")
-    buffer = ""
+    reader = LineReader(MAX_LINE_LENGTH)
 
     try:
         while True:
-            data = conn.recv(1024)
-            if not data:
+            try:
+                lines = reader.recv_lines(conn)
+            except ValueError:
+                lines = [b'']
+            if lines is None:
                 break
-            print(f"Data received {data.decode()}")               
-            buffer += data.decode()
+            if not lines:
+                continue
 
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                is_valid, response = parse_request(line)
-                conn.sendall((json.dumps(response) + '\n').encode())
+            responses, malformed = answer_lines_blocking(lines, process_pool)
+            conn.sendall(responses)
 
-                if not is_valid:
-                    print(f"Malformed request from {addr}. Disconnecting.")
-                    conn.close()
-                    return
+            if malformed:
+                print(f"Malformed request from {addr}. Disconnecting.")
+                conn.close()
+                return
 
     except Exception as e:
         print(f"Error with {addr}: {e}")
@@ -83,18 +499,101 @@ def handle_client(conn, addr):
 
 def start_server():
     """Starts the TCP server and accepts clients."""
+    build_sieve(SIEVE_LIMIT)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((HOST, PORT))
         server.listen()
         print(f"Server listening on {HOST}:{PORT}")
 
+        try:
+            while True:
+                conn, addr = server.accept()
+                thread = threading.Thread(target=handle_client, args=(conn, addr))
+                thread.start()
+        except KeyboardInterrupt:
+            print(f"Cache stats: {prime_cache.stats()}")
+
+
+async def handle_client_async(reader, writer):
+    """Handles a client on the event loop, one coalesced write per read."""
+    addr = writer.get_extra_info('peername')
+    print(f"Connected by {addr}")
+    framer = LineReader(MAX_LINE_LENGTH)
+
+    try:
         while True:
-            conn, addr = server.accept()
-            thread = threading.Thread(target=handle_client, args=(conn, addr))
-            thread.start()
+            data = await reader.read(65536)
+            if not data:
+                break
+            try:
+                lines = framer.feed(data)
+            except ValueError:
+                lines = [b'']
+            if not lines:
+                continue
+
+            responses, malformed = await answer_lines(lines, process_pool)
+            writer.write(responses)
+            await writer.drain()
+
+            if malformed:
+                print(f"Malformed request from {addr}. Disconnecting.")
+                return
+
+    except Exception as e:
+        print(f"Error with {addr}: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        print(f"Disconnected from {addr}")
+
+
+async def start_async_server():
+    """Starts the asyncio TCP server."""
+    build_sieve(SIEVE_LIMIT)
+    server = await asyncio.start_server(handle_client_async, HOST, PORT)
+    print(f"Server listening on {HOST}:{PORT} (asyncio)")
+
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            print(f"Cache stats: {prime_cache.stats()}")
+
+
+def main():
+    global SIEVE_LIMIT, PORT
+
+    parser = argparse.ArgumentParser(description="Prime Time server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with asyncio instead of one thread per client")
+    parser.add_argument("--engine", choices=sorted(PRIMALITY_ENGINES), default="bpsw")
+    parser.add_argument("--sieve-limit", type=int, default=SIEVE_LIMIT)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="check numbers wider than the engine's INLINE_MAX_BITS "
+                             "in this many processes")
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    SIEVE_LIMIT = args.sieve_limit
+    PORT = args.port
+    set_primality_engine(args.engine)
+    if args.workers > 0:
+        start_process_pool(args.workers, args.engine)
+
+    if args.use_async:
+        try:
+            asyncio.run(start_async_server())
+        except KeyboardInterrupt:
+            pass
+    else:
+        start_server()
 
 
 if __name__ == "__main__":
-    start_server()
+    main()
 
@@ -0,0 +1,190 @@
+import importlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import common
+
+prime_time = importlib.import_module("2")
+
+# Trial division on anything bigger takes seconds to minutes per number
+TRIAL_MAX_DIGITS = 13
+DIGIT_SIZES = [6, 9, 12, 13, 19, 30, 100, 300, 1000]
+
+
+def next_prime(n):
+    """Smallest prime >= n, found with the default engine."""
+    n |= 1
+    while not prime_time.is_prime_bpsw(n):
+        n += 2
+    return n
+
+
+def time_call(func, n, repeat):
+    """Returns the mean seconds per call of func(n)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(n)
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_engines():
+    """Compares every primality engine on primes of increasing size."""
+    names = list(prime_time.PRIMALITY_ENGINES)
+    print(f"{'digits':>7} " + " ".join(f"{name:>14}" for name in names))
+
+    for digits in DIGIT_SIZES:
+        n = next_prime(10 ** (digits - 1))
+        repeat = 200 if digits < 100 else 5
+        row = []
+        for name in names:
+            if name == "trial" and digits > TRIAL_MAX_DIGITS:
+                row.append(f"{'skipped':>14}")
+                continue
+            func = prime_time.PRIMALITY_ENGINES[name]
+            per_call = time_call(func, n, 1 if name == "trial" else repeat)
+            row.append(f"{per_call * 1e6:>12.1f}us")
+        print(f"{digits:>7} " + " ".join(row))
+
+
+def bench_parse_request():
+    """Worst-case parse_request latency with the default engine."""
+    print("\nparse_request latency (default engine)")
+    for digits in DIGIT_SIZES:
+        line = f'{{"method":"isPrime","number":{next_prime(10 ** (digits - 1))}}}'
+        per_call = time_call(prime_time.parse_request, line, 20)
+        print(f"{digits:>7} digits: {per_call * 1e6:>10.1f}us")
+
+
+def bench_cache(requests=200_000, distinct=5_000):
+    """Skewed traffic over numbers above the sieve, with and without the cache."""
+    print("\nsieve + LRU cache")
+    start = time.perf_counter()
+    prime_time.build_sieve(prime_time.SIEVE_LIMIT)
+    print(f"sieve up to {prime_time.SIEVE_LIMIT}: {time.perf_counter() - start:.2f}s, "
+          f"{len(prime_time.prime_sieve.bits)} bytes")
+
+    rng = random.Random(1)
+    base = 10**18
+    hot = [base + rng.randrange(10**12) for _ in range(distinct)]
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    workload = rng.choices(hot, weights, k=requests)
+
+    start = time.perf_counter()
+    for n in workload:
+        prime_time.primality_engine(n)
+    uncached = time.perf_counter() - start
+
+    prime_time.prime_cache.clear()
+    start = time.perf_counter()
+    for n in workload:
+        prime_time.is_prime(n)
+    cached = time.perf_counter() - start
+
+    print(f"{requests} requests over {distinct} numbers: "
+          f"uncached {uncached:.2f}s, cached {cached:.2f}s")
+    print(f"cache stats: {prime_time.prime_cache.stats()}")
+
+
+def split_lines_str(chunks):
+    """The framing handle_client used to do: decode, then split per line."""
+    buffer = ""
+    lines = []
+    for chunk in chunks:
+        buffer += chunk.decode()
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            lines.append(line)
+    return lines
+
+
+def split_lines_reader(chunks):
+    reader = prime_time.LineReader(prime_time.MAX_LINE_LENGTH)
+    lines = []
+    for chunk in chunks:
+        lines += reader.feed(chunk)
+    return lines
+
+
+def bench_framing(count=100_000):
+    """Frames and decodes a pipelined burst of count requests."""
+    print(f"\nline framing, {count} pipelined requests")
+    rng = random.Random(3)
+    burst = "".join(json.dumps({"method": "isPrime", "number": rng.randrange(10**12)}) + "\n"
+                    for _ in range(count)).encode()
+
+    print(f"{'read size':>10} {'framer':>11} {'framing':>9} {'+ decode':>9}")
+    for chunk_size in (1024, 65536, 1 << 20):
+        chunks = [burst[i:i + chunk_size] for i in range(0, len(burst), chunk_size)]
+        for name, framer in (("str split", split_lines_str), ("LineReader", split_lines_reader)):
+            start = time.perf_counter()
+            lines = framer(chunks)
+            framed = time.perf_counter() - start
+            for line in lines:
+                prime_time.decode_request(line)
+            total = time.perf_counter() - start
+            assert len(lines) == count
+            print(f"{chunk_size:>10} {name:>11} {framed:>8.3f}s {total:>8.3f}s")
+
+
+def run_load_client(port, payload, expected_lines, results, index):
+    """Sends one pipelined batch and waits for every response line."""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(payload)
+        received = 0
+        while received < expected_lines:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received += data.count(b"\n")
+    results[index] = received
+
+
+def bench_load(connections=8, per_connection=50, digits=150, port=65433):
+    """Throughput of expensive requests as the process pool grows."""
+    print(f"\nprocess pool load test ({connections} connections x "
+          f"{per_connection} requests, {digits}-digit numbers)")
+    # Distinct numbers everywhere so the result cache never helps
+    rng = random.Random(2)
+    payloads = []
+    for _ in range(connections):
+        numbers = [next_prime(rng.randrange(10 ** (digits - 1), 10 ** digits))
+                   for _ in range(per_connection)]
+        payloads.append("".join(json.dumps({"method": "isPrime", "number": n}) + "\n"
+                                for n in numbers).encode())
+
+    cores = os.cpu_count() or 1
+    worker_counts = [0] + sorted({w for w in (1, 2, 4, cores) if w <= cores})
+    for workers in worker_counts:
+        server = common.start_process("2.py", "--workers", str(workers),
+                                      "--sieve-limit", "1000", "--port", str(port), port=port)
+        try:
+            results = [0] * connections
+            threads = [
+                threading.Thread(target=run_load_client,
+                                 args=(port, payloads[i], per_connection, results, i))
+                for i in range(connections)
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            common.stop_process(server)
+
+        label = "inline" if workers == 0 else f"{workers} worker(s)"
+        print(f"{label:>14}: {sum(results) / elapsed:>8.1f} req/s "
+              f"({sum(results)} responses in {elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    bench_engines()
+    bench_parse_request()
+    bench_cache()
+    bench_framing()
+    bench_load()
@@ -0,0 +1,123 @@
+import importlib
+import json
+import random
+import socket
+import time
+
+import common
+
+kvtest = importlib.import_module("4test")
+
+HOST = "127.0.0.1"
+PORT = 65480
+# Two primes near 2**31: trial division would take minutes over their product
+SEMIPRIME = 2147483647 * 2147483629
+# A small sieve, so the semiprime is left to the engine
+SIEVE_LIMIT = 1000
+# Requests sent in one write; some are past the inline limit and finish out of order
+PIPELINED = 200
+# Server flags for each way of serving, all with the trial division engine
+MODES = {
+    "threads": [],
+    "async": ["--async"],
+    "async+workers": ["--async", "--workers", "2"],
+}
+
+
+def request(number):
+    return (json.dumps({"method": "isPrime", "number": number}) + "\n").encode()
+
+
+def ask(sock, number):
+    sock.sendall(request(number))
+    reply = b""
+    while not reply.endswith(b"\n"):
+        data = sock.recv(4096)
+        if not data:
+            raise EOFError("connection closed")
+        reply += data
+    return json.loads(reply)
+
+
+def is_prime(n):
+    """Plain trial division, for checking replies."""
+    if n < 2:
+        return False
+    i = 2
+    while i * i <= n:
+        if n % i == 0:
+            return False
+        i += 1
+    return True
+
+
+def test_semiprime_off_the_loop():
+    """A slow trial-division check doesn't hold up another client's cheap request."""
+    with socket.create_connection((HOST, PORT)) as slow, \
+         socket.create_connection((HOST, PORT), timeout=2.0) as quick:
+        slow.sendall(request(SEMIPRIME))
+        time.sleep(0.2)
+        reply = ask(quick, 7919)
+    assert reply == {"method": "isPrime", "prime": True}, f"Got {reply!r}"
+
+
+def test_small_numbers_inline():
+    with socket.create_connection((HOST, PORT), timeout=2.0) as sock:
+        for number, prime in ((65521, True), (65521 * 65519, False), (4294967291, True)):
+            reply = ask(sock, number)
+            assert reply["prime"] is prime, f"{number}: got {reply!r}"
+
+
+def test_pipelined_in_order():
+    """Requests sent in one write come back in the order they were sent."""
+    rng = random.Random(3)
+    # Up to 36 bits: the bigger ones leave the inline path, yet stay quick to check
+    numbers = [rng.randrange(2, 2 ** rng.choice((16, 32, 36))) for _ in range(PIPELINED)]
+    with socket.create_connection((HOST, PORT), timeout=5.0) as sock:
+        sock.sendall(b"".join(request(number) for number in numbers))
+        replies = []
+        data = b""
+        while len(replies) < len(numbers):
+            chunk = sock.recv(65536)
+            assert chunk, f"connection closed after {len(replies)} replies"
+            data += chunk
+            *lines, data = data.split(b"\n")
+            replies += [json.loads(line) for line in lines]
+    for number, reply in zip(numbers, replies):
+        assert reply == {"method": "isPrime", "prime": is_prime(number)}, f"{number}: got {reply!r}"
+
+
+def test_malformed_after_valid():
+    """A valid request, then a malformed one, in one write: the answer, the malformed reply, EOF."""
+    with socket.create_connection((HOST, PORT), timeout=2.0) as sock:
+        sock.sendall(request(7919) + b'{"method": "isPrime"}\n' + request(13))
+        data = b""
+        while chunk := sock.recv(65536):
+            data += chunk
+    lines = data.split(b"\n")
+    assert len(lines) == 3 and lines[2] == b"", f"Got {data!r}"
+    assert json.loads(lines[0]) == {"method": "isPrime", "prime": True}, f"Got {data!r}"
+    assert json.loads(lines[1]) == {"malformed": True}, f"Got {data!r}"
+
+
+def run_tests(mode):
+    """Runs the tests against 2.py in the given mode, with the trial division engine."""
+    print(f"🚀 Starting Prime Time Tests ({mode}, trial division)\n")
+    server = common.start_process("2.py", *MODES[mode], "--engine", "trial", "--port", str(PORT),
+                                  "--sieve-limit", str(SIEVE_LIMIT), port=PORT)
+    try:
+        runner = kvtest.TestRunner()
+        runner.test("Small numbers answered", test_small_numbers_inline)
+        runner.test(f"{PIPELINED} pipelined requests in order", test_pipelined_in_order)
+        runner.test("Malformed request after a valid one", test_malformed_after_valid)
+        # Last: the semiprime keeps the server busy until it is stopped
+        runner.test("Large semiprime doesn't hold up others", test_semiprime_off_the_loop)
+        return runner.print_summary()
+    finally:
+        common.stop_process(server)
+
+
+if __name__ == "__main__":
+    modes = common.parse_names("Tests for 2.py", MODES, "MODE", "serving modes to test")
+    results = [run_tests(mode) for mode in modes]
+    exit(0 if all(results) else 1)
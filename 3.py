@@ -1,61 +1,396 @@
+import argparse
 import socket
 import threading
 import struct
-from collections import defaultdict
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain, islice
 
 HOST = '127.0.0.1'
 PORT = 65432
 
-# Each client gets its own list of (timestamp, price) entries
-client_data = defaultdict(list)
+MESSAGE = struct.Struct('>cii')
+RESPONSE = struct.Struct('>i')
+RECV_SIZE = 65536
+# A session whose prices take more than this is disconnected
+MAX_SESSION_BYTES = 64 << 20
 
-def insert(addr, timestamp, price):
-    client_data[addr].append((timestamp, price))
 
-def query(addr, mintime, maxtime):
-    if mintime > maxtime:
-        return 0
+class ListPriceStore:
+    """One session's prices as a plain list of (timestamp, price); queries scan it."""
 
-    prices = [price for (ts, price) in client_data[addr] if mintime <= ts <= maxtime]
+    def __init__(self):
+        self.entries = []
 
-    if not prices:
-        return 0
+    def __len__(self):
+        return len(self.entries)
 
-    return sum(prices) // len(prices)  # integer mean
+    def insert(self, timestamp, price):
+        self.entries.append((timestamp, price))
+
+    def insert_many(self, entries):
+        self.entries.extend(entries)
+
+    def nbytes(self):
+        """Approximate memory held by the stored prices."""
+        entry = sys.getsizeof((0, 0)) + 2 * sys.getsizeof(1 << 20)
+        return sys.getsizeof(self.entries) + len(self.entries) * entry
+
+    def query(self, mintime, maxtime):
+        if mintime > maxtime:
+            return 0
+
+        prices = [price for (ts, price) in self.entries if mintime <= ts <= maxtime]
+
+        if not prices:
+            return 0
+
+        return sum(prices) // len(prices)  # integer mean
+
+
+class SortedPriceStore:
+    """
+    One session's prices, kept sorted by timestamp in array columns next
+    to a prefix-sum column, so a range mean is two bisects and a
+    subtraction. Out-of-order inserts wait in a buffer and are merged
+    in one pass by the next query.
+    """
+
+    MAX_PENDING = 4096  # merge early once this many inserts are buffered
+
+    def __init__(self):
+        self.timestamps = array('i')
+        self.prices = array('i')
+        self.prefix = array('q', [0])  # prefix[i] = sum(prices[:i])
+        self.pending = []              # (timestamp, price) not merged yet
+
+    def __len__(self):
+        return len(self.timestamps) + len(self.pending)
+
+    def insert(self, timestamp, price):
+        timestamps = self.timestamps
+        if not self.pending and (not timestamps or timestamp >= timestamps[-1]):
+            timestamps.append(timestamp)
+            self.prices.append(price)
+            self.prefix.append(self.prefix[-1] + price)
+        else:
+            self.pending.append((timestamp, price))
+            if len(self.pending) >= self.MAX_PENDING:
+                self.merge()
+
+    def insert_many(self, entries):
+        """Inserts a batch of (timestamp, price) pairs."""
+        if not entries:
+            return
+        timestamps = [timestamp for timestamp, _ in entries]
+        in_order = (
+            not self.pending
+            and (not self.timestamps or timestamps[0] >= self.timestamps[-1])
+            and all(a <= b for a, b in zip(timestamps, islice(timestamps, 1, None)))
+        )
+        if not in_order:
+            self.pending.extend(entries)
+            if len(self.pending) >= self.MAX_PENDING:
+                self.merge()
+            return
+
+        prices = [price for _, price in entries]
+        self.timestamps.extend(timestamps)
+        self.prices.extend(prices)
+        self.prefix.extend(islice(accumulate(prices, initial=self.prefix[-1]), 1, None))
+
+    def nbytes(self):
+        """Approximate memory held by the stored prices."""
+        pending = len(self.pending) * (sys.getsizeof((0, 0)) + 2 * sys.getsizeof(1 << 20))
+        return (sys.getsizeof(self.timestamps) + sys.getsizeof(self.prices)
+                + sys.getsizeof(self.prefix) + sys.getsizeof(self.pending) + pending)
+
+    def merge(self):
+        """Merges buffered out-of-order inserts into the sorted columns."""
+        if not self.pending:
+            return
+        pending = sorted(self.pending)
+        self.pending = []
+
+        # Only the tail from the earliest pending timestamp on changes
+        timestamps = self.timestamps
+        prices = self.prices
+        cut = bisect_right(timestamps, pending[0][0])
+
+        if len(pending) * 32 < len(timestamps) - cut:
+            # A few stragglers: shift them into place
+            for timestamp, price in pending:
+                i = bisect_right(timestamps, timestamp)
+                timestamps.insert(i, timestamp)
+                prices.insert(i, price)
+        else:
+            merged = sorted(chain(zip(timestamps[cut:], prices[cut:]), pending))
+            del timestamps[cut:]
+            del prices[cut:]
+            timestamps.extend(timestamp for timestamp, _ in merged)
+            prices.extend(price for _, price in merged)
+
+        base = self.prefix[cut]
+        del self.prefix[cut:]
+        self.prefix.extend(accumulate(prices[cut:], initial=base))
+
+    def query(self, mintime, maxtime):
+        if mintime > maxtime:
+            return 0
+        self.merge()
+
+        lo = bisect_left(self.timestamps, mintime)
+        hi = bisect_right(self.timestamps, maxtime)
+        if lo == hi:
+            return 0
+        return (self.prefix[hi] - self.prefix[lo]) // (hi - lo)  # integer mean
+
+
+class FenwickPriceStore:
+    """
+    One session's prices in sorted blocks of array columns, with Fenwick
+    trees of each block's price sum and count. An insert bisects to its
+    block, shifts at most 2 * BLOCK entries and updates the trees in
+    O(log blocks); a block that grows past that is split in two and the
+    trees, one node per block, are rebuilt. A range mean adds up whole
+    blocks from the trees and sums the two partial blocks at its ends.
+    """
+
+    BLOCK = 1024  # entries per block after a split
+
+    def __init__(self):
+        self.timestamps = []           # one sorted array('i') per block
+        self.prices = []               # array('i') per block, beside timestamps
+        self.firsts = []               # each block's first timestamp, for bisecting
+        self.block_sums = []           # each block's price sum
+        self.sums = array('q', [0])    # Fenwick nodes over blocks, 1-based
+        self.counts = array('q', [0])
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def insert(self, timestamp, price):
+        if not self.timestamps:
+            self.timestamps.append(array('i'))
+            self.prices.append(array('i'))
+            self.firsts.append(timestamp)
+            self.block_sums.append(0)
+            self.rebuild()
+
+        j = max(bisect_right(self.firsts, timestamp) - 1, 0)
+        timestamps = self.timestamps[j]
+        i = bisect_right(timestamps, timestamp)
+        timestamps.insert(i, timestamp)
+        self.prices[j].insert(i, price)
+        if i == 0:
+            self.firsts[j] = timestamp
+        self.block_sums[j] += price
+        self.length += 1
+
+        if len(timestamps) > 2 * self.BLOCK:
+            self.split(j)
+        else:
+            self.add(j + 1, price)
+
+    def insert_many(self, entries):
+        for timestamp, price in entries:
+            self.insert(timestamp, price)
+
+    def nbytes(self):
+        """Approximate memory held by the stored prices."""
+        blocks = sum(sys.getsizeof(timestamps) + sys.getsizeof(prices)
+                     for timestamps, prices in zip(self.timestamps, self.prices))
+        per_block = sys.getsizeof(1 << 40) + 4 * 8  # a block sum, and list slots
+        return (blocks + len(self.timestamps) * per_block
+                + sys.getsizeof(self.sums) + sys.getsizeof(self.counts))
+
+    def add(self, i, price):
+        sums = self.sums
+        counts = self.counts
+        n = len(self.timestamps)
+        while i <= n:
+            sums[i] += price
+            counts[i] += 1
+            i += i & -i
+
+    def split(self, j):
+        """Splits block j in two halves and rebuilds the trees."""
+        timestamps, prices = self.timestamps[j], self.prices[j]
+        half = len(timestamps) // 2
+        self.timestamps[j + 1:j + 1] = [timestamps[half:]]
+        self.prices[j + 1:j + 1] = [prices[half:]]
+        del timestamps[half:]
+        del prices[half:]
+        self.firsts.insert(j + 1, self.timestamps[j + 1][0])
+        moved = sum(self.prices[j + 1])
+        self.block_sums[j] -= moved
+        self.block_sums.insert(j + 1, moved)
+        self.rebuild()
+
+    def rebuild(self):
+        """Builds the trees from the block sums and lengths."""
+        self.sums = sums = array('q', [0])
+        self.counts = counts = array('q', [0])
+        sums.extend(self.block_sums)
+        counts.extend(len(timestamps) for timestamps in self.timestamps)
+        n = len(self.timestamps)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                sums[j] += sums[i]
+                counts[j] += counts[i]
+
+    def totals_before(self, timestamp, side):
+        """
+        Returns (sum, count) of the prices at timestamps below timestamp,
+        or up to it when side is bisect_right.
+        """
+        j = side(self.firsts, timestamp) - 1
+        if j < 0:
+            return 0, 0
+        k = side(self.timestamps[j], timestamp)
+        total = sum(self.prices[j][:k])
+        count = k
+        sums = self.sums
+        counts = self.counts
+        while j > 0:
+            total += sums[j]
+            count += counts[j]
+            j &= j - 1
+        return total, count
+
+    def query(self, mintime, maxtime):
+        if mintime > maxtime:
+            return 0
+
+        high_total, high_count = self.totals_before(maxtime, bisect_right)
+        low_total, low_count = self.totals_before(mintime, bisect_left)
+        count = high_count - low_count
+        if count == 0:
+            return 0
+        return (high_total - low_total) // count  # integer mean
+
+
+STORE_BACKENDS = {
+    "list": ListPriceStore,
+    "sorted": SortedPriceStore,
+    "fenwick": FenwickPriceStore,
+}
+store_backend = SortedPriceStore
+
+
+def set_store_backend(name):
+    """Selects the store class used for new sessions (one of STORE_BACKENDS)."""
+    global store_backend
+    if name not in STORE_BACKENDS:
+        raise ValueError(f"Unknown store backend: {name}")
+    store_backend = STORE_BACKENDS[name]
+
+
+class SessionLimitExceeded(Exception):
+    pass
+
+
+class SessionStore:
+    """
+    The price store of every connected client. A session's store is
+    dropped as soon as its connection closes, and a session may not
+    hold more than max_bytes of prices.
+    """
+
+    def __init__(self, max_bytes=MAX_SESSION_BYTES):
+        self.max_bytes = max_bytes
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self, addr):
+        store = store_backend()
+        with self.lock:
+            self.sessions[addr] = store
+        return store
+
+    def close(self, addr):
+        with self.lock:
+            self.sessions.pop(addr, None)
+
+    def check(self, store):
+        """Raises SessionLimitExceeded if store is over the per-session cap."""
+        if store.nbytes() > self.max_bytes:
+            raise SessionLimitExceeded(f"session holds more than {self.max_bytes} bytes")
+
+    def resident_bytes(self):
+        """Approximate memory held by all open sessions."""
+        with self.lock:
+            stores = list(self.sessions.values())
+        return sum(store.nbytes() for store in stores)
+
+
+# Each client gets its own store of (timestamp, price) entries
+sessions = SessionStore()
+
+def handle_messages(store, view):
+    """
+    Applies every message in view (a whole number of 9-byte messages).
+    Consecutive inserts go to the store as one batch.
+    Returns (responses: bytes, ok: bool); ok is False after an unknown
+    message type.
+    """
+    responses = []
+    inserts = []
+
+    for msg_type, int1, int2 in MESSAGE.iter_unpack(view):
+        if msg_type == b'I':
+            inserts.append((int1, int2))
+        elif msg_type == b'Q':
+            if inserts:
+                store.insert_many(inserts)
+                inserts = []
+            responses.append(RESPONSE.pack(store.query(int1, int2)))
+        else:
+            print("Unknown message type:", msg_type)
+            store.insert_many(inserts)
+            return b''.join(responses), False  # undefined behavior
+
+    store.insert_many(inserts)
+    sessions.check(store)
+    return b''.join(responses), True
 
 def handle_client(conn, addr):
     print(f"Connected by {addr}")
+    store = sessions.open(addr)
+    # Room for one read plus a partial message carried over from the last
+    buffer = bytearray(RECV_SIZE + MESSAGE.size)
+    view = memoryview(buffer)
+    filled = 0
     try:
         while True:
-            data = b''
-            while len(data) < 9:
-                packet = conn.recv(9 - len(data))
-                if not packet:
-                    return
-                data += packet
-
-            msg_type = data[0:1]
-            int1 = struct.unpack('>i', data[1:5])[0]
-            int2 = struct.unpack('>i', data[5:9])[0]
-            msg = msg_type.decode('ascii')
-
-            if msg == 'I':
-                insert(addr, int1, int2)
-                print("client data.......")
-                print(client_data)
-
-            elif msg == 'Q':
-                result = query(addr, int1, int2)
-                conn.sendall(struct.pack('>i', result))
-            else:
-                print("Unknown message type:", msg)
-                return  # undefined behavior
+            n = conn.recv_into(view[filled:filled + RECV_SIZE])
+            if not n:
+                return
+            filled += n
+
+            complete = filled - filled % MESSAGE.size
+            responses, ok = handle_messages(store, view[:complete])
+            if responses:
+                conn.sendall(responses)
+            if not ok:
+                return
+
+            buffer[:filled - complete] = buffer[complete:filled]
+            filled -= complete
 
     except Exception as e:
         print(f"Error with {addr}: {e}")
     finally:
         conn.close()
-        print(f"Disconnected from {addr}")
+        sessions.close(addr)
+        print(f"Disconnected from {addr} "
+              f"({len(sessions)} sessions, {sessions.resident_bytes()} bytes resident)")
 
 def start_server():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
@@ -69,5 +404,20 @@ def start_server():
             thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
             thread.start()
 
-if __name__ == "__main__":
+def main():
+    global PORT
+
+    parser = argparse.ArgumentParser(description="Means to an End server")
+    parser.add_argument("--backend", choices=sorted(STORE_BACKENDS), default="sorted")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-session-bytes", type=int, default=MAX_SESSION_BYTES)
+    args = parser.parse_args()
+
+    PORT = args.port
+    set_store_backend(args.backend)
+    sessions.max_bytes = args.max_session_bytes
     start_server()
+
+
+if __name__ == "__main__":
+    main()
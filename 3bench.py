@@ -0,0 +1,109 @@
+import importlib
+import random
+import time
+import tracemalloc
+
+means = importlib.import_module("3")
+
+INSERTS = 50_000
+QUERIES = 500
+# The list backend scans every insert per query; keep its runs short
+LIST_MAX_INSERTS = 20_000
+
+
+def make_workload(order, inserts, queries, seed=0):
+    """
+    Returns a list of ('I', timestamp, price) / ('Q', mintime, maxtime)
+    messages. Queries are spread evenly through the inserts.
+    """
+    rng = random.Random(seed)
+    timestamps = list(range(0, inserts * 10, 10))
+    if order == "random":
+        rng.shuffle(timestamps)
+
+    messages = []
+    every = max(1, inserts // queries)
+    for i, timestamp in enumerate(timestamps, 1):
+        messages.append(('I', timestamp, rng.randrange(-1000, 100_000)))
+        if i % every == 0:
+            low = rng.randrange(0, inserts * 10)
+            messages.append(('Q', low, low + rng.randrange(inserts * 5)))
+    return messages
+
+
+def run_workload(store, messages):
+    """Returns (insert seconds, query seconds)."""
+    insert_time = query_time = 0.0
+    results = []
+    for kind, a, b in messages:
+        start = time.perf_counter()
+        if kind == 'I':
+            store.insert(a, b)
+            insert_time += time.perf_counter() - start
+        else:
+            results.append(store.query(a, b))
+            query_time += time.perf_counter() - start
+    return insert_time, query_time, results
+
+
+def bench_backends(inserts=INSERTS, queries=QUERIES):
+    print(f"{'order':>8} {'backend':>8} {'inserts':>8} {'insert':>9} {'query':>9} {'total':>9}")
+    for order in ("monotone", "random"):
+        expected = None
+        for name, backend in means.STORE_BACKENDS.items():
+            count = min(inserts, LIST_MAX_INSERTS) if name == "list" else inserts
+            messages = make_workload(order, count, queries * count // inserts)
+            insert_time, query_time, results = run_workload(backend(), messages)
+            if count == inserts:
+                assert expected is None or results == expected, f"{name} disagrees"
+                expected = results
+            print(f"{order:>8} {name:>8} {count:>8} {insert_time:>8.3f}s "
+                  f"{query_time:>8.3f}s {insert_time + query_time:>8.3f}s")
+
+
+def bench_insert_scaling(sizes=(100_000, 200_000, 400_000)):
+    """
+    Per-insert cost of random-order inserts as the store grows. A store
+    with logarithmic inserts keeps this about flat; one that re-sorts or
+    shifts everything grows with the size.
+    """
+    print("\nrandom inserts, time per insert")
+    print(f"{'backend':>8}" + "".join(f"{size:>12,}" for size in sizes))
+    for name, backend in means.STORE_BACKENDS.items():
+        if name == "list":
+            continue  # inserts are appends; its cost is in the queries
+        row = f"{name:>8}"
+        for size in sizes:
+            rng = random.Random(5)
+            entries = [(rng.randrange(-2**31, 2**31), rng.randrange(-1000, 100_000))
+                       for _ in range(size)]
+            store = backend()
+            start = time.perf_counter()
+            for timestamp, price in entries:
+                store.insert(timestamp, price)
+            elapsed = time.perf_counter() - start
+            row += f"{elapsed / size * 1e6:>10.2f}us"
+        print(row)
+
+
+def bench_memory(records=1_000_000):
+    """Measured (tracemalloc) and reported (nbytes) memory per stored price."""
+    print(f"\nmemory for {records} random prices")
+    print(f"{'backend':>8} {'measured':>12} {'per record':>11} {'nbytes()':>12}")
+    for name, backend in means.STORE_BACKENDS.items():
+        # Values are created inside the traced window, as the server would
+        rng = random.Random(4)
+        tracemalloc.start()
+        store = backend()
+        for i in range(records):
+            store.insert(i * 1000 - 2**30, rng.randrange(-2**31, 2**31))
+        measured, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>8} {measured:>12,} {measured / records:>10.1f}B {store.nbytes():>12,}")
+        del store
+
+
+if __name__ == "__main__":
+    bench_backends()
+    bench_insert_scaling()
+    bench_memory()
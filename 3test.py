@@ -0,0 +1,80 @@
+import importlib
+import random
+
+kvtest = importlib.import_module("4test")
+means = importlib.import_module("3")
+
+# Random timestamps per session, and queries over them
+RANDOM_RECORDS = 40_000
+QUERIES = 200
+# Messages per handle_messages() call, about one read's worth
+BATCH = means.RECV_SIZE // means.MESSAGE.size
+
+
+def make_random_records(count, seed=0):
+    rng = random.Random(seed)
+    return [(rng.randrange(-2**31, 2**31), rng.randrange(-1000, 100_000)) for _ in range(count)]
+
+
+def make_random_session_test(backend):
+    """
+    Inserts random-timestamp records through the session store under the
+    default cap, then checks query answers against a plain scan.
+    """
+    def test_random_session():
+        means.set_store_backend(backend)
+        records = make_random_records(RANDOM_RECORDS)
+        addr = ("test", backend)
+        store = means.sessions.open(addr)
+        try:
+            for i in range(0, len(records), BATCH):
+                messages = b"".join(means.MESSAGE.pack(b"I", timestamp, price)
+                                    for timestamp, price in records[i:i + BATCH])
+                _, ok = means.handle_messages(store, memoryview(messages))
+                assert ok, "insert batch refused"
+            assert store.nbytes() <= means.MAX_SESSION_BYTES, f"{store.nbytes()} bytes"
+
+            rng = random.Random(1)
+            for _ in range(QUERIES):
+                low = rng.randrange(-2**31, 2**31)
+                high = low + rng.randrange(2**30)
+                prices = [price for timestamp, price in records if low <= timestamp <= high]
+                expected = sum(prices) // len(prices) if prices else 0
+                got = store.query(low, high)
+                assert got == expected, f"query({low}, {high}) = {got}, expected {expected}"
+        finally:
+            means.sessions.close(addr)
+    return test_random_session
+
+
+def make_duplicate_test(backend):
+    """
+    Many prices at few timestamps, so runs of one timestamp straddle the
+    fenwick store's block splits; queries end on stored timestamps.
+    """
+    def test_duplicates():
+        rng = random.Random(2)
+        records = [(rng.randrange(100), rng.randrange(-1000, 100_000)) for _ in range(10_000)]
+        store = means.STORE_BACKENDS[backend]()
+        for timestamp, price in records:
+            store.insert(timestamp, price)
+        for low in range(0, 100, 7):
+            for high in (low, low + 1, low + 30):
+                prices = [price for timestamp, price in records if low <= timestamp <= high]
+                expected = sum(prices) // len(prices) if prices else 0
+                got = store.query(low, high)
+                assert got == expected, f"query({low}, {high}) = {got}, expected {expected}"
+    return test_duplicates
+
+
+def run_tests():
+    print("🚀 Starting Means to an End Store Tests\n")
+    runner = kvtest.TestRunner()
+    for backend in means.STORE_BACKENDS:
+        runner.test(f"{RANDOM_RECORDS:,} random records ({backend})", make_random_session_test(backend))
+        runner.test(f"Repeated timestamps ({backend})", make_duplicate_test(backend))
+    return runner.print_summary()
+
+
+if __name__ == "__main__":
+    exit(0 if run_tests() else 1)
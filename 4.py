@@ -1,68 +1,821 @@
+import argparse
+import asyncio
+import heapq
+import mmap
+import multiprocessing
+import os
+import queue
+import select
+import signal
 import socket
+import struct
+import threading
+import time
+from array import array
+from itertools import accumulate
+from multiprocessing.connection import wait
 
 UDP_IP = "127.0.0.1"
 UDP_PORT = 12345
 
+# Datagrams a worker reads per wakeup before checking for replicated inserts
+RECV_BATCH = 64
+
 # Global store for all clients
 store = {}
+# Per-packet logging in the single-process server
+verbose = True
+# Inserts made by this worker that still have to be sent to the writer
+replica_log = None
+# Optional StoreLog that makes inserts survive a restart
+durable = None
+# Optional ResponseCache for retrieves
+response_cache = None
+
+# Group commit: the log is flushed once this many inserts are buffered...
+GROUP_COMMIT_RECORDS = 4096
+# ...or once the oldest buffered insert is this many seconds old
+GROUP_COMMIT_INTERVAL = 0.05
+# A snapshot is taken after this many logged inserts
+SNAPSHOT_EVERY = 1_000_000
+# Encoded retrieve responses kept for hot keys
+RESPONSE_CACHE_SIZE = 65536
+# Hot keys printed on SIGUSR1
+HOT_KEYS_SHOWN = 20
+
+VERSION_RESPONSE = b"version=Ken's Key-Value Store 1.0"
+
+
+class StoreLog:
+    """
+    Durability for the store: an append-only log of inserts, flushed and
+    fsynced in groups, plus compacted snapshots that replace the log.
+
+    Both files are a sequence of blocks: a header, the length of every
+    key and value as one native-endian array('I'), then the keys and
+    values back to back. An insert only appends to a list; the block is
+    built once per flush.
+
+    A snapshot is written by a forked child from its copy-on-write view
+    of the store, so serving never waits on it. When it starts, the log
+    is rotated to log.prev; the child removes log.prev once the snapshot
+    is safely renamed into place. Recovery mmaps the snapshot and replays
+    log.prev (if still there) and then the log.
+    """
+
+    BLOCK = struct.Struct('>II')  # number of entries, bytes of data
+    SNAPSHOT_BLOCK_ENTRIES = 65536
+
+    def __init__(self, directory, group_records=GROUP_COMMIT_RECORDS,
+                 group_interval=GROUP_COMMIT_INTERVAL, snapshot_every=SNAPSHOT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.log_path = os.path.join(directory, "store.log")
+        self.prev_log_path = self.log_path + ".prev"
+        self.snapshot_path = os.path.join(directory, "store.snapshot")
+        self.group_records = group_records
+        self.group_interval = group_interval
+        self.snapshot_every = snapshot_every
+
+        self.pending = []  # key, value, key, value, ...
+        self.first_pending = 0.0
+        self.logged = 0
+        self.snapshot_pid = None
+        self.log_file = None
+
+    def open(self):
+        self.log_file = open(self.log_path, 'ab')
+
+    def append(self, key, value):
+        pending = self.pending
+        if not pending:
+            self.first_pending = time.monotonic()
+        pending.append(key)
+        pending.append(value)
+        if len(pending) >= 2 * self.group_records:
+            self.flush()
+
+    def tick(self, store):
+        """Call regularly: flushes a stale group and starts due snapshots."""
+        if self.pending and time.monotonic() - self.first_pending >= self.group_interval:
+            self.flush()
+        if self.snapshot_pid is not None:
+            pid, _ = os.waitpid(self.snapshot_pid, os.WNOHANG)
+            if pid:
+                self.snapshot_pid = None
+        elif self.logged >= self.snapshot_every:
+            self.start_snapshot(store)
+
+    def encode_block(self, items):
+        """items is a flat key, value, key, value, ... list."""
+        lengths = array('I', map(len, items))
+        data = b''.join(items)
+        return self.BLOCK.pack(len(items) // 2, len(data)) + lengths.tobytes() + data
+
+    def flush(self):
+        """Writes and fsyncs every pending insert as one group."""
+        if not self.pending:
+            return
+        self.log_file.write(self.encode_block(self.pending))
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.logged += len(self.pending) // 2
+        self.pending = []
+
+    def close(self):
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
+
+    def start_snapshot(self, store):
+        """Rotates the log and writes a snapshot of store in the background."""
+        if os.path.exists(self.prev_log_path):
+            # A previous snapshot never finished; fold that log in first
+            self.write_snapshot(store)
+        self.flush()
+        self.log_file.close()
+        os.replace(self.log_path, self.prev_log_path)
+        self.open()
+        self.logged = 0
+
+        if not hasattr(os, 'fork'):
+            self.write_snapshot(store)
+            return
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.write_snapshot(store)
+            finally:
+                os._exit(0)
+        self.snapshot_pid = pid
+
+    def write_snapshot(self, store):
+        tmp_path = self.snapshot_path + ".tmp"
+        items = []
+        with open(tmp_path, 'wb') as f:
+            for key, value in store.items():
+                items.append(key)
+                items.append(value)
+                if len(items) >= 2 * self.SNAPSHOT_BLOCK_ENTRIES:
+                    f.write(self.encode_block(items))
+                    items = []
+            if items:
+                f.write(self.encode_block(items))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.prev_log_path):
+            os.remove(self.prev_log_path)
+
+    def replay(self, path, store):
+        """
+        Applies every complete block of a log or snapshot file to store.
+        Returns the length of the intact part; a torn tail is ignored.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                while offset + self.BLOCK.size <= len(mm):
+                    count, size = self.BLOCK.unpack_from(mm, offset)
+                    lengths_start = offset + self.BLOCK.size
+                    data_start = lengths_start + 2 * count * 4
+                    end = data_start + size
+                    if end > len(mm):
+                        break
+
+                    lengths = array('I')
+                    lengths.frombytes(mm[lengths_start:data_start])
+                    data = mm[data_start:end]
+                    bounds = list(accumulate(lengths, initial=0))
+                    items = [data[a:b] for a, b in zip(bounds, bounds[1:])]
+                    store.update(zip(items[0::2], items[1::2]))
+                    offset = end
+        return offset
+
+    def load(self, recovered=None):
+        """
+        Returns the store as saved on disk, without touching the files.
+        Entries go into recovered if given, else into a new dict.
+        """
+        if recovered is None:
+            recovered = {}
+        self.replay(self.snapshot_path, recovered)
+        self.replay(self.prev_log_path, recovered)
+        self.replay(self.log_path, recovered)
+        return recovered
+
+    def recover(self, recovered=None):
+        """Rebuilds the store from disk and opens the log for appending."""
+        if recovered is None:
+            recovered = {}
+        self.replay(self.snapshot_path, recovered)
+        self.replay(self.prev_log_path, recovered)
+        intact = self.replay(self.log_path, recovered)
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > intact:
+            os.truncate(self.log_path, intact)
+        self.open()
+        return recovered
+
+
+class ArenaStore:
+    """
+    A bytes -> bytes mapping kept in three flat buffers instead of a dict
+    of bytes objects. Every key and value lives in one bytearray arena as
+    a (key length, value length, key, value) record. The table is open
+    addressing with linear probing over two arrays: the arena offset of
+    each slot's record (+1, so 0 means empty) and the low 32 bits of the
+    key's hash, compared before any key bytes are.
+
+    Keys are never deleted. A value of the same length is overwritten in
+    place; otherwise the new record is appended and the old one becomes
+    garbage, which is compacted away once it is half the arena.
+    """
+
+    RECORD = struct.Struct('<HH')  # key length, value length
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1024):
+        self.clear(capacity)
+
+    def clear(self, capacity=1024):
+        self.arena = bytearray()
+        self.offsets = array('Q', bytes(8 * capacity))
+        self.hashes = array('I', bytes(4 * capacity))
+        self.mask = capacity - 1
+        self.count = 0
+        self.garbage = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, key, h):
+        """Returns the slot holding key, or the empty slot it belongs in."""
+        offsets, hashes, arena = self.offsets, self.hashes, self.arena
+        unpack_from = self.RECORD.unpack_from
+        size = len(key)
+        mask = self.mask
+        i = h & mask
+        while True:
+            offset = offsets[i]
+            if not offset:
+                return i
+            if hashes[i] == h:
+                key_size, _ = unpack_from(arena, offset - 1)
+                if key_size == size and arena.startswith(key, offset + 3):
+                    return i
+            i = (i + 1) & mask
+
+    def _value(self, offset):
+        start = offset - 1
+        key_size, value_size = self.RECORD.unpack_from(self.arena, start)
+        start += 4 + key_size
+        return bytes(self.arena[start:start + value_size])
+
+    def get(self, key, default=None):
+        offset = self.offsets[self._slot(key, hash(key) & 0xFFFFFFFF)]
+        return self._value(offset) if offset else default
+
+    def __getitem__(self, key):
+        offset = self.offsets[self._slot(key, hash(key) & 0xFFFFFFFF)]
+        if not offset:
+            raise KeyError(key)
+        return self._value(offset)
+
+    def __contains__(self, key):
+        return self.offsets[self._slot(key, hash(key) & 0xFFFFFFFF)] != 0
+
+    def __setitem__(self, key, value):
+        h = hash(key) & 0xFFFFFFFF
+        i = self._slot(key, h)
+        arena = self.arena
+        old = self.offsets[i]
+        if old:
+            key_size, value_size = self.RECORD.unpack_from(arena, old - 1)
+            if value_size == len(value):
+                start = old + 3 + key_size
+                arena[start:start + value_size] = value
+                return
+            self.garbage += 4 + key_size + value_size
+        else:
+            self.count += 1
+
+        self.offsets[i] = len(arena) + 1
+        self.hashes[i] = h
+        arena += self.RECORD.pack(len(key), len(value)) + key + value
+
+        if self.count > self.MAX_LOAD * (self.mask + 1):
+            self._rehash(2 * (self.mask + 1))
+        elif self.garbage > len(arena) // 2:
+            self._compact()
+
+    def update(self, items):
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def items(self):
+        arena = self.arena
+        unpack_from = self.RECORD.unpack_from
+        for offset in self.offsets:
+            if offset:
+                key_size, value_size = unpack_from(arena, offset - 1)
+                start = offset + 3
+                yield (bytes(arena[start:start + key_size]),
+                       bytes(arena[start + key_size:start + key_size + value_size]))
+
+    def _rehash(self, capacity):
+        offsets = array('Q', bytes(8 * capacity))
+        hashes = array('I', bytes(4 * capacity))
+        mask = capacity - 1
+        for offset, h in zip(self.offsets, self.hashes):
+            if offset:
+                i = h & mask
+                while offsets[i]:
+                    i = (i + 1) & mask
+                offsets[i] = offset
+                hashes[i] = h
+        self.offsets, self.hashes, self.mask = offsets, hashes, mask
+
+    def _compact(self):
+        arena = self.arena
+        compacted = bytearray()
+        offsets = self.offsets
+        unpack_from = self.RECORD.unpack_from
+        for i, offset in enumerate(offsets):
+            if offset:
+                key_size, value_size = unpack_from(arena, offset - 1)
+                offsets[i] = len(compacted) + 1
+                compacted += arena[offset - 1:offset + 3 + key_size + value_size]
+        self.arena = compacted
+        self.garbage = 0
+
+    def nbytes(self):
+        return (len(self.arena) + self.offsets.itemsize * len(self.offsets)
+                + self.hashes.itemsize * len(self.hashes))
+
+
+class ResponseCache:
+    """
+    Fully encoded retrieve responses for the keys that are read the most.
+    entries maps a key to a [response, hits] list, which retrieve() reads
+    and updates directly; hits counts every retrieve of the key since it
+    was cached. An insert clears the response but keeps the count. When
+    the cache is full the colder half of it is evicted.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = {}
+
+    def put(self, key, response):
+        """Caches the response for a key that has no entry yet."""
+        if len(self.entries) >= self.maxsize:
+            self.evict()
+        self.entries[key] = [response, 0]
+
+    def invalidate(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = None
+
+    def evict(self):
+        keep = heapq.nlargest(self.maxsize // 2, self.entries.items(), key=lambda item: item[1][1])
+        self.entries = dict(keep)
+
+    def hot_keys(self, n=HOT_KEYS_SHOWN):
+        """The n most-hit cached keys as (key, hits), hottest first."""
+        hottest = heapq.nlargest(n, self.entries.items(), key=lambda item: item[1][1])
+        return [(key, entry[1]) for key, entry in hottest]
+
+    def stats(self):
+        return {"size": len(self.entries),
+                "hits": sum(entry[1] for entry in self.entries.values())}
+
+
+STORE_BACKENDS = {
+    "dict": dict,
+    "arena": ArenaStore,
+}
+
+
+def set_store_backend(name):
+    """Replaces the (empty) store with one of STORE_BACKENDS."""
+    global store
+    if name not in STORE_BACKENDS:
+        raise ValueError(f"Unknown store backend: {name}")
+    store = STORE_BACKENDS[name]()
+
 
 def insert(key, value):
-    if key == 'version':
+    if key == b'version':
         return
-    
+
+    store[key] = value
+    if response_cache is not None:
+        response_cache.invalidate(key)
+    if replica_log is not None:
+        replica_log.append((key, value))
+    if durable is not None:
+        durable.append(key, value)
+    if verbose:
+        print(f"Stored: {key.decode(errors='replace')}={value.decode(errors='replace')}")
+
+def apply_replicated(key, value):
+    """Applies an insert another process already validated."""
     store[key] = value
-    print(f"Stored: {key}={value}")
+    if response_cache is not None:
+        response_cache.invalidate(key)
+    if durable is not None:
+        durable.append(key, value)
+
+def enable_durability(directory):
+    """Recovers the store from directory and logs every insert from now on."""
+    global durable
+    durable = StoreLog(directory)
+    start = time.perf_counter()
+    durable.recover(store)
+    print(f"Recovered {len(store)} keys from {directory} in {time.perf_counter() - start:.2f}s")
 
 def retrieve(key):
-    if key in store:
-        return f"{key}={store[key]}".encode()
+    if response_cache is None:
+        return key + b"=" + store.get(key, b"")
+    entry = response_cache.entries.get(key)
+    if entry is not None and entry[0] is not None:
+        entry[1] += 1
+        return entry[0]
+    response = key + b"=" + store.get(key, b"")
+    if entry is not None:
+        entry[0] = response
+        entry[1] += 1
     else:
-        return f"{key}=".encode()
+        response_cache.put(key, response)
+    return response
 
 def get_version():
-    return "version=Ken's Key-Value Store 1.0".encode()
+    return VERSION_RESPONSE
+
+def enable_response_cache(maxsize):
+    """Caches retrieve responses; SIGUSR1 prints the hottest keys."""
+    global response_cache
+    response_cache = ResponseCache(maxsize)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_hot_keys())
+
+def dump_hot_keys(n=HOT_KEYS_SHOWN):
+    print(f"[{os.getpid()}] response cache {response_cache.stats()}", flush=True)
+    for key, hits in response_cache.hot_keys(n):
+        print(f"  {hits:>10} {key.decode(errors='replace')}", flush=True)
 
 def parse_key_value(data):
-    index = data.find('=')
+    index = data.find(b'=')
     if index == -1:
         return None, None
-    
+
     key = data[:index]
     value = data[index+1:]
     return key, value
 
-def main():
+def handle_datagram(raw_data):
+    """
+    Handles one request datagram. Returns the response, or None.
+    Keys and values stay bytes from the datagram to the store and back.
+    """
+    msg = raw_data.strip()
+
+    if msg == b"version":
+        return get_version()
+    elif b'=' in msg:
+        key, value = parse_key_value(msg)
+        insert(key, value)
+        return None
+    else:
+        return retrieve(msg)
+
+def make_socket():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((UDP_IP, UDP_PORT))
+    return sock
+
+def main():
+    sock = make_socket()
+    if durable is not None:
+        # Non-blocking, so the log is looked after whenever we go idle
+        sock.setblocking(False)
     print(f"UDP server running on {UDP_IP}:{UDP_PORT}")
-    
+
     try:
+        handled = 0
         while True:
-            raw_data, addr = sock.recvfrom(1024)
-            msg = raw_data.decode().strip()
-            print(f"Received from {addr}: '{msg}'")
-            
-            response = None
-            
-            if msg == "version":
-                response = get_version()
-            elif '=' in msg:
-                key, value = parse_key_value(msg)
-                if key is not None:
-                    insert(key, value)
-                    print(f"Insert complete: {key}={value}")
+            if durable is not None:
+                try:
+                    raw_data, addr = sock.recvfrom(1024)
+                except BlockingIOError:
+                    durable.tick(store)
+                    select.select([sock], [], [], durable.group_interval)
                     continue
+                handled += 1
+                if handled % RECV_BATCH == 0:
+                    durable.tick(store)
             else:
-                response = retrieve(msg)
-            
+                raw_data, addr = sock.recvfrom(1024)
+            if verbose:
+                print(f"Received from {addr}: '{raw_data.decode(errors='replace').strip()}'")
+
+            response = handle_datagram(raw_data)
+
             if response is not None:
-                sock.sendto(response, addr)
-                print(f"Sent to {addr}: '{response.decode()}'")
-    
+                try:
+                    sock.sendto(response, addr)
+                except BlockingIOError:
+                    continue  # send buffer full; the reply is lost like any datagram
+                if verbose:
+                    print(f"Sent to {addr}: '{response.decode(errors='replace')}'")
+
     except KeyboardInterrupt:
         print("\nServer shutting down...")
     finally:
         sock.close()
+        if durable is not None:
+            durable.close()
+
+class KeyValueProtocol(asyncio.DatagramProtocol):
+    """
+    The server as an asyncio DatagramProtocol, so other work can share
+    its event loop. Every datagram is answered from datagram_received.
+    While the transport's send buffer is over its high-water mark the
+    protocol is paused, and replies are dropped instead of queued, as a
+    full socket buffer would drop them.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.paused = False
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = handle_datagram(data)
+        if response is not None:
+            if self.paused:
+                self.dropped += 1
+            else:
+                self.transport.sendto(response, addr)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+async def serve_async():
+    """Serves on the event loop, without per-packet logging; the log is ticked by a timer."""
+    global verbose
+    verbose = False
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        KeyValueProtocol, local_addr=(UDP_IP, UDP_PORT))
+    print(f"UDP server running on {UDP_IP}:{UDP_PORT} (asyncio)")
+
+    try:
+        while True:
+            if durable is not None:
+                await asyncio.sleep(durable.group_interval)
+                durable.tick(store)
+            else:
+                await asyncio.sleep(3600)
+    finally:
+        transport.close()
+        if durable is not None:
+            durable.close()
+        print(f"\nServer shutting down... ({protocol.dropped} replies dropped under backpressure)")
+
+def apply_updates(updates, unacked, ours):
+    """
+    Applies a batch of numbered inserts the writer sent back, in order,
+    and returns the last one's number. Inserts numbered in ours were
+    made by this worker and are already applied.
+    """
+    for seq, key, value in updates:
+        if seq in ours:
+            ours.remove(seq)
+            if unacked[key] == seq:
+                del unacked[key]
+        elif key not in unacked:
+            apply_replicated(key, value)
+        # else a later insert of ours to key supersedes this one
+    return seq
+
+def send_replica_log(conn, unacked):
+    """Sends the inserts this worker made since the last call to the writer."""
+    global replica_log
+    if replica_log:
+        for seq, key, _ in replica_log:
+            unacked[key] = seq
+        conn.send(replica_log)
+        replica_log = []
+
+def serve_worker(conn, sock, recv_lock, inserts_seen, data_dir=None, backend="dict", cache_size=0):
+    """
+    One of several processes reading the writer's UDP socket. Reads
+    are served from this worker's replica of the store. Inserts are
+    applied locally at once and sent to the writer, which sends every
+    worker's inserts back to all in the order they left the socket.
+
+    Datagrams are taken off the socket under recv_lock, and an insert
+    is numbered from inserts_seen before the lock is released. A
+    retrieve notes inserts_seen as it is taken, and waits for the
+    writer until this replica has applied that many inserts, so it
+    sees each insert that arrived before it, whichever worker read it.
+
+    With data_dir the replica starts from what the writer persisted.
+    Each worker keeps its own response cache.
+    """
+    global verbose, replica_log
+    verbose = False
+    set_store_backend(backend)
+    if data_dir is not None:
+        StoreLog(data_dir).load(store)
+    if cache_size:
+        enable_response_cache(cache_size)
+    replica_log = []
+
+    sock.setblocking(False)
+    # Keys with inserts of ours the writer hasn't echoed back yet, and
+    # the number of the latest; earlier inserts to them are superseded.
+    unacked = {}
+    # Numbers of all our inserts the writer hasn't echoed back yet
+    ours = set()
+    # Number of the last insert the writer sent back
+    applied = 0
+
+    try:
+        while True:
+            ready, _, _ = select.select([sock, conn], [], [])
+
+            if conn in ready:
+                while conn.poll():
+                    applied = apply_updates(conn.recv(), unacked, ours)
+
+            if sock in ready:
+                # No recvmmsg in Python; drain the socket instead
+                for _ in range(RECV_BATCH):
+                    with recv_lock:
+                        try:
+                            raw_data, addr = sock.recvfrom(1024)
+                        except BlockingIOError:
+                            break
+                        if b'=' in raw_data:
+                            logged = len(replica_log)
+                            handle_datagram(raw_data)
+                            if len(replica_log) > logged:
+                                inserts_seen.value += 1
+                                replica_log[-1] = (inserts_seen.value, *replica_log[-1])
+                                ours.add(inserts_seen.value)
+                            continue
+                        seen = inserts_seen.value
+
+                    # Only wait if some insert not sent back yet is another worker's
+                    if seen - applied > len(ours):
+                        # The writer can only send back inserts it has been sent
+                        send_replica_log(conn, unacked)
+                        while seen - applied > len(ours):
+                            applied = apply_updates(conn.recv(), unacked, ours)
+
+                    response = handle_datagram(raw_data)
+                    if response is not None:
+                        try:
+                            sock.sendto(response, addr)
+                        except BlockingIOError:
+                            pass
+
+                send_replica_log(conn, unacked)
+
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        sock.close()
+
+def send_updates(conn, updates):
+    """Writer-side sender for one worker, so a full pipe never blocks the writer."""
+    while True:
+        batch = updates.get()
+        if batch is None:
+            return
+        try:
+            conn.send(batch)
+        except OSError:
+            return
+
+def serve_workers(workers, backend="dict", cache_size=0):
+    """
+    Runs the writer: binds the socket, starts the workers that read it
+    and applies and sends back their inserts in the order they were
+    numbered.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    sock = make_socket()
+    recv_lock = ctx.Lock()
+    inserts_seen = ctx.Value('q', 0, lock=False)
+    conns = []
+    processes = []
+    outboxes = []
+
+    for _ in range(workers):
+        parent_conn, child_conn = ctx.Pipe()
+        data_dir = durable.directory if durable is not None else None
+        process = ctx.Process(target=serve_worker, args=(child_conn, sock, recv_lock, inserts_seen,
+                                                           data_dir, backend, cache_size),
+                              daemon=True)
+        process.start()
+        child_conn.close()
+
+        outbox = queue.SimpleQueue()
+        threading.Thread(target=send_updates, args=(parent_conn, outbox), daemon=True).start()
+        conns.append(parent_conn)
+        processes.append(process)
+        outboxes.append(outbox)
+
+    if cache_size and hasattr(signal, 'SIGUSR1'):
+        # The caches live in the workers; pass the request for hot keys on
+        signal.signal(signal.SIGUSR1, lambda signum, frame: [
+            os.kill(process.pid, signal.SIGUSR1) for process in processes])
+    print(f"UDP server running on {UDP_IP}:{UDP_PORT} with {workers} workers")
+
+    timeout = durable.group_interval if durable is not None else None
+    # Inserts that arrived ahead of a lower-numbered one from another worker
+    early = []
+    next_seq = 1
+    try:
+        while conns:
+            if durable is not None:
+                durable.tick(store)
+            for conn in wait(conns, timeout):
+                try:
+                    updates = conn.recv()
+                except EOFError:
+                    conns.remove(conn)
+                    continue
+                for update in updates:
+                    heapq.heappush(early, update)
+                ready = []
+                while early and early[0][0] == next_seq:
+                    ready.append(heapq.heappop(early))
+                    next_seq += 1
+                if not ready:
+                    continue
+                for _, key, value in ready:
+                    apply_replicated(key, value)
+                for outbox in outboxes:
+                    outbox.put(ready)
+    except KeyboardInterrupt:
+        print("\nServer shutting down...")
+    finally:
+        for outbox in outboxes:
+            outbox.put(None)
+        for process in processes:
+            process.terminate()
+        sock.close()
+        if durable is not None:
+            durable.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Unusual Database Program server")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve from this many processes sharing one socket")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with an asyncio DatagramProtocol (single process)")
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--quiet", action="store_true", help="no per-packet logging")
+    parser.add_argument("--data-dir", help="persist the store in this directory")
+    parser.add_argument("--store", choices=sorted(STORE_BACKENDS), default="dict",
+                        help="dict of bytes, or the compact bytearray-arena table")
+    parser.add_argument("--response-cache", type=int, default=0, metavar="SIZE",
+                        help=f"cache encoded responses for up to SIZE hot keys "
+                             f"(e.g. {RESPONSE_CACHE_SIZE}); SIGUSR1 dumps hit counts")
+    args = parser.parse_args()
+    if args.use_async and args.workers > 0:
+        parser.error("--async serves from a single process; drop --workers")
+
+    UDP_PORT = args.port
+    verbose = not args.quiet
+    set_store_backend(args.store)
+    if args.data_dir:
+        enable_durability(args.data_dir)
+    if args.workers > 0:
+        serve_workers(args.workers, args.store, args.response_cache)
+    else:
+        if args.response_cache:
+            enable_response_cache(args.response_cache)
+        if args.use_async:
+            try:
+                asyncio.run(serve_async())
+            except KeyboardInterrupt:
+                pass
+        else:
+            main()
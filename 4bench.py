@@ -0,0 +1,326 @@
+import importlib
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+import tracemalloc
+
+import common
+
+kv = importlib.import_module("4")
+
+SERVER_IP = "127.0.0.1"
+BENCH_PORT = 12399
+DURATION = 3.0
+GENERATORS = 4
+# Requests each generator keeps in flight
+WINDOW = 32
+# One insert for every INSERT_EVERY requests; the rest are retrieves
+INSERT_EVERY = 10
+
+
+def start_server(*args, port=BENCH_PORT):
+    """Starts 4.py quietly; returns the Popen once it answers."""
+    return common.start_process("4.py", "--quiet", "--port", str(port), *args, port=port, udp=True)
+
+
+def generate_load(port, duration, window, results):
+    """Keeps window requests outstanding for duration seconds."""
+    addr = (SERVER_IP, port)
+    pid = os.getpid()
+    requests = [f"key{pid}-{i % 100}".encode() for i in range(INSERT_EVERY - 1)]
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        sent = received = lost = 0
+        outstanding = 0
+        i = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            while outstanding < window:
+                i += 1
+                if i % INSERT_EVERY == 0:
+                    sock.sendto(f"key{pid}-{i % 100}=value{i}".encode(), addr)
+                else:
+                    sock.sendto(requests[i % len(requests)], addr)
+                    outstanding += 1
+                sent += 1
+            try:
+                sock.recv(1024)
+                received += 1
+                outstanding -= 1
+            except socket.timeout:
+                lost += outstanding
+                outstanding = 0
+
+    results.put((sent, received, lost))
+
+
+def run_load(port, generators=GENERATORS, duration=DURATION, window=WINDOW):
+    """Returns (datagrams sent, responses received, responses lost)."""
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=generate_load, args=(port, duration, window, results))
+        for _ in range(generators)
+    ]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return tuple(map(sum, zip(*totals)))
+
+
+def bench_pps():
+    """Packets per second for the single-process server and N workers."""
+    print(f"packets/sec, {GENERATORS} generators x {WINDOW} in flight, {DURATION:.0f}s each")
+    cores = os.cpu_count() or 1
+    modes = [("single process", []), ("asyncio", ["--async"])]
+    modes += [(f"{n} workers", ["--workers", str(n)]) for n in sorted({1, 2, cores}) if n <= cores]
+
+    for label, args in modes:
+        server = start_server(*args)
+        try:
+            sent, received, lost = run_load(BENCH_PORT)
+        finally:
+            common.stop_process(server)
+        print(f"{label:>15}: {sent / DURATION:>9,.0f} sent/s {received / DURATION:>9,.0f} answered/s "
+              f"{lost / max(1, sent):>7.2%} lost")
+
+
+def time_inserts(datagrams):
+    """Seconds to push insert datagrams through handle_datagram."""
+    handle = kv.handle_datagram
+    start = time.perf_counter()
+    for raw in datagrams:
+        handle(raw)
+    if kv.durable is not None:
+        kv.durable.flush()
+    return time.perf_counter() - start
+
+
+def stream_inserts(port, count, window=64):
+    """
+    Sends count inserts to a server, window at a time, each window
+    followed by a retrieve whose reply paces the stream.
+    Returns (seconds, windows that timed out).
+    """
+    addr = (SERVER_IP, port)
+    timeouts = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.5)
+        start = time.perf_counter()
+        for base in range(0, count, window):
+            for i in range(base, min(count, base + window)):
+                sock.sendto(b"key%d=value%d" % (i % 100_000, i), addr)
+            sock.sendto(b"key0", addr)
+            try:
+                sock.recv(1024)
+            except socket.timeout:
+                timeouts += 1
+        return time.perf_counter() - start, timeouts
+
+
+def bench_durable_writes(count=1_000_000, server_count=200_000):
+    """Insert throughput in memory and with the group-committed log."""
+    print(f"\ninsert throughput, handle_datagram only, {count} inserts")
+    kv.verbose = False
+    datagrams = [f"key{i % 100_000}=value{i}".encode() for i in range(count)]
+
+    kv.store.clear()
+    in_memory = time_inserts(datagrams)
+
+    directory = tempfile.mkdtemp()
+    try:
+        kv.store.clear()
+        kv.durable = kv.StoreLog(directory, snapshot_every=count + 1)
+        kv.durable.recover()
+        logged = time_inserts(datagrams)
+        kv.durable.close()
+    finally:
+        kv.durable = None
+        shutil.rmtree(directory)
+    kv.store.clear()
+
+    print(f"     in memory: {count / in_memory:>10,.0f} inserts/s")
+    print(f"with StoreLog: {count / logged:>10,.0f} inserts/s "
+          f"(+{(logged - in_memory) / count * 1e6:.2f}us per insert)")
+
+    print(f"\ninsert throughput, UDP server, {server_count} inserts")
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for label, args in (("in memory", []), ("with StoreLog", ["--data-dir", directory])):
+            server = start_server(*args)
+            try:
+                results[label] = stream_inserts(BENCH_PORT, server_count)
+            finally:
+                common.stop_process(server)
+    finally:
+        shutil.rmtree(directory)
+
+    for label, (elapsed, timeouts) in results.items():
+        print(f"{label:>14}: {server_count / elapsed:>10,.0f} inserts/s ({timeouts} stalled windows)")
+    ratio = results["in memory"][0] / results["with StoreLog"][0]
+    print(f"StoreLog keeps {ratio:.1%} of in-memory throughput")
+
+
+def bench_recovery(keys=10_000_000, log_records=100_000):
+    """Startup recovery time from a snapshot of keys entries plus a log tail."""
+    print(f"\nrecovery, {keys:,} keys in the snapshot + {log_records:,} logged inserts")
+    directory = tempfile.mkdtemp()
+    try:
+        durable = kv.StoreLog(directory)
+        store = {b"key%d" % i: b"value%d" % i for i in range(keys)}
+        start = time.perf_counter()
+        durable.write_snapshot(store)
+        print(f"snapshot written in {time.perf_counter() - start:.2f}s "
+              f"({os.path.getsize(durable.snapshot_path):,} bytes)")
+        del store
+
+        durable.open()
+        for i in range(log_records):
+            durable.append(b"key%d" % i, b"new%d" % i)
+        durable.close()
+
+        start = time.perf_counter()
+        recovered = kv.StoreLog(directory).recover()
+        elapsed = time.perf_counter() - start
+        assert len(recovered) == keys and recovered[b"key0"] == b"new0"
+        print(f"recovered in {elapsed:.2f}s")
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_storage(keys=1_000_000):
+    """Memory per key and request throughput for each store backend."""
+    print(f"\nstore backends, {keys:,} keys through handle_datagram")
+    kv.verbose = False
+    rng = random.Random(12)
+    inserts = [b"user:%d:session=%x" % (i, rng.getrandbits(64)) for i in range(keys)]
+    retrieves = [b"user:%d:session" % rng.randrange(keys) for _ in range(keys)]
+    handle = kv.handle_datagram
+
+    print(f"{'backend':>8} {'measured':>13} {'per key':>9} {'inserts/s':>11} {'retrieves/s':>12}")
+    expected = None
+    for name in kv.STORE_BACKENDS:
+        # Keys and values are sliced out of the datagrams inside the traced window
+        tracemalloc.start()
+        kv.set_store_backend(name)
+        for raw in inserts:
+            handle(raw)
+        measured, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Timed again untraced; tracemalloc slows every allocation
+        kv.set_store_backend(name)
+        start = time.perf_counter()
+        for raw in inserts:
+            handle(raw)
+        insert_time = time.perf_counter() - start
+        start = time.perf_counter()
+        responses = [handle(raw) for raw in retrieves]
+        retrieve_time = time.perf_counter() - start
+        assert expected is None or responses == expected, f"{name} disagrees"
+        expected = responses
+
+        print(f"{name:>8} {measured:>13,} {measured / keys:>8.1f}B "
+              f"{keys / insert_time:>11,.0f} {keys / retrieve_time:>12,.0f}")
+    kv.set_store_backend("dict")
+
+
+def bench_response_cache(keys=100_000, requests=500_000):
+    """Steady-state request throughput over Zipf-skewed keys, with and without the cache."""
+    print(f"\nresponse cache, {requests:,} requests over {keys:,} keys, after one warm-up pass")
+    kv.verbose = False
+    rng = random.Random(13)
+    weights = [1 / (rank + 1) for rank in range(keys)]
+    hot = rng.choices(range(keys), weights, k=requests)
+
+    for mix, insert_every in (("read only", 0), (f"1 insert per {INSERT_EVERY}", INSERT_EVERY)):
+        datagrams = [b"key%d=new%d" % (k, i) if insert_every and i % insert_every == 0
+                     else b"key%d" % k for i, k in enumerate(hot)]
+        results = {}
+        expected = None  # the uncached responses, which the cached run must match
+        for label, cache in (("no cache", None), ("cached", kv.ResponseCache())):
+            kv.set_store_backend("dict")
+            for i in range(keys):
+                kv.handle_datagram(b"key%d=value%d" % (i, i))
+            kv.response_cache = cache
+            handle = kv.handle_datagram
+            for raw in datagrams:
+                handle(raw)
+            start = time.perf_counter()
+            responses = [handle(raw) for raw in datagrams]
+            results[label] = time.perf_counter() - start
+            assert expected is None or responses == expected, "cache served a stale response"
+            expected = responses
+        kv.response_cache = None
+        print(f"{mix:>20}: " + ", ".join(f"{label} {requests / elapsed:,.0f}/s"
+                                          for label, elapsed in results.items()))
+
+    print(f"cache stats: {cache.stats()}")
+    print("hottest keys: " + ", ".join(f"{key.decode()} ({hits})" for key, hits in cache.hot_keys(5)))
+    kv.store.clear()
+
+
+def measure_latency(port, count):
+    """Round-trip times in microseconds of count serial retrieves, sorted; lost ones left out."""
+    addr = (SERVER_IP, port)
+    latencies = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        sock.sendto(b"latency=probe", addr)
+        for i in range(count):
+            start = time.perf_counter()
+            sock.sendto(b"latency", addr)
+            try:
+                sock.recv(1024)
+            except socket.timeout:
+                continue
+            latencies.append((time.perf_counter() - start) * 1e6)
+    latencies.sort()
+    return latencies
+
+
+def bench_latency(count=20_000, generators=2):
+    """Round-trip latency of the blocking loop and the asyncio protocol, idle and under load."""
+    print(f"\nlatency, {count:,} serial retrieves; loaded = {generators} generators x {WINDOW} in flight")
+    print(f"{'server':>9} {'load':>7} {'p50':>8} {'p99':>8} {'p99.9':>8} {'lost':>6}")
+    for label, args in (("blocking", []), ("asyncio", ["--async"])):
+        for loaded in (False, True):
+            server = start_server(*args)
+            load = []
+            try:
+                if loaded:
+                    load = [multiprocessing.Process(target=generate_load,
+                                                    args=(BENCH_PORT, 3600, WINDOW, multiprocessing.Queue()))
+                            for _ in range(generators)]
+                    for process in load:
+                        process.start()
+                    time.sleep(0.5)
+                latencies = measure_latency(BENCH_PORT, count)
+            finally:
+                for process in load:
+                    process.terminate()
+                common.stop_process(server)
+            print(f"{label:>9} {'loaded' if loaded else 'idle':>7} "
+                  + " ".join(f"{common.percentile(latencies, q):>6.0f}us" for q in (0.5, 0.99, 0.999))
+                  + f" {count - len(latencies):>6}")
+
+
+BENCHES = {
+    "pps": bench_pps,
+    "durable": bench_durable_writes,
+    "recovery": bench_recovery,
+    "storage": bench_storage,
+    "response-cache": bench_response_cache,
+    "latency": bench_latency,
+}
+
+if __name__ == "__main__":
+    for name in common.parse_names("Unusual Database Program benchmarks", BENCHES, "BENCH", "benches to run"):
+        BENCHES[name]()
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import random
+import time
+from array import array
+from itertools import accumulate
+
+import common
+
+kvtest = importlib.import_module("4test")
+
+VERSION_RESPONSE = b"version=Ken's Key-Value Store 1.0"
+# Requests generated up front per process, then cycled through
+POOL_SIZE = 200_000
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """
+    One simulated client: a socket with at most one request in flight.
+    Only a reply that starts with the expected prefix completes the
+    request, so a late reply to an earlier, timed-out request can't.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.waiter = None
+        self.expect = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done() and data.startswith(self.expect):
+            waiter.set_result(data)
+
+
+def parse_mix(text):
+    """'retrieve=80,insert=15,version=5' -> {'retrieve': 80.0, ...}"""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("retrieve", "insert", "version"):
+            raise argparse.ArgumentTypeError(f"unknown request kind: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def make_requests(count, keys, zipf, mix, value_size, seed):
+    """
+    Returns count (datagram, expected reply prefix) pairs. Keys follow a
+    Zipf distribution with exponent zipf; rank 0 is the hottest. The
+    prefix is None for inserts, which get no reply.
+    """
+    rng = random.Random(seed)
+    cum_weights = list(accumulate(1 / (rank + 1) ** zipf for rank in range(keys)))
+    ranks = rng.choices(range(keys), cum_weights=cum_weights, k=count)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    value = b"v" * value_size
+
+    requests = []
+    for rank, kind in zip(ranks, kinds):
+        key = b"key%d" % rank
+        if kind == "retrieve":
+            requests.append((key, key + b"="))
+        elif kind == "insert":
+            requests.append((key + b"=" + value, None))
+        else:
+            requests.append((b"version", VERSION_RESPONSE))
+    return requests
+
+
+async def run_client(transport, client, requests, start, deadline, timeout, stats):
+    loop = asyncio.get_running_loop()
+    latencies = stats["latencies"]
+    i = start
+    while loop.time() < deadline:
+        datagram, expect = requests[i % len(requests)]
+        i += 1
+        if expect is None:
+            transport.sendto(datagram)
+            stats["inserts"] += 1
+            # Nothing to wait for; let the other clients and the deadline in
+            await asyncio.sleep(0)
+            continue
+
+        client.expect = expect
+        client.waiter = loop.create_future()
+        sent = time.perf_counter()
+        transport.sendto(datagram)
+        try:
+            await asyncio.wait_for(client.waiter, timeout)
+        except asyncio.TimeoutError:
+            stats["lost"] += 1
+            continue
+        latencies.append((time.perf_counter() - sent) * 1e6)
+
+
+async def generate_load(addr, concurrency, requests, duration, timeout):
+    loop = asyncio.get_running_loop()
+    stats = {"latencies": array('d'), "inserts": 0, "lost": 0}
+    endpoints = [await loop.create_datagram_endpoint(LoadClient, remote_addr=addr)
+                 for _ in range(concurrency)]
+    deadline = loop.time() + duration
+    try:
+        await asyncio.gather(*(
+            run_client(transport, client, requests, n * len(requests) // concurrency,
+                       deadline, timeout, stats)
+            for n, (transport, client) in enumerate(endpoints)))
+    finally:
+        for transport, _ in endpoints:
+            transport.close()
+    return stats
+
+
+def load_process(addr, concurrency, duration, timeout, workload, seed, results):
+    """One load-generating process: its own event loop and request pool."""
+    requests = make_requests(POOL_SIZE, seed=seed, **workload)
+    stats = asyncio.run(generate_load(addr, concurrency, requests, duration, timeout))
+    results.put((stats["latencies"].tobytes(), stats["inserts"], stats["lost"]))
+
+
+def run_load(addr, processes, concurrency, duration, timeout, workload):
+    """
+    Spreads concurrency clients over processes and runs them for
+    duration seconds. Returns (sorted latencies in us, inserts sent,
+    replies lost).
+    """
+    results = multiprocessing.Queue()
+    shares = [concurrency // processes + (n < concurrency % processes) for n in range(processes)]
+    workers = [
+        multiprocessing.Process(target=load_process,
+                                args=(addr, share, duration, timeout, workload, n, results))
+        for n, share in enumerate(shares) if share
+    ]
+    for worker in workers:
+        worker.start()
+
+    latencies = array('d')
+    inserts = lost = 0
+    for _ in workers:
+        raw, worker_inserts, worker_lost = results.get()
+        latencies.frombytes(raw)
+        inserts += worker_inserts
+        lost += worker_lost
+    for worker in workers:
+        worker.join()
+    return sorted(latencies), inserts, lost
+
+
+def print_report(latencies, inserts, lost, duration):
+    answered = len(latencies)
+    expected = answered + lost
+    print(f"requests: {(expected + inserts) / duration:>10,.0f}/s "
+          f"({answered:,} answered, {lost:,} lost, {inserts:,} inserts sent)")
+    if latencies:
+        print("latency:  " + "  ".join(
+            f"{label} {common.percentile(latencies, q):,.0f}us"
+            for label, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)))
+              + f"  max {latencies[-1]:,.0f}us")
+    print(f"loss:     {lost / max(1, expected):.3%} of requests that expect a reply")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load and latency harness for the Unusual Database Program servers")
+    parser.add_argument("--host", default=kvtest.SERVER_IP)
+    parser.add_argument("--port", type=int, default=kvtest.SERVER_PORT)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="load-generating processes, each with its own event loop")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="clients in total, each with one request in flight")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--timeout", type=float, default=0.5,
+                        help="seconds before a missing reply counts as lost")
+    parser.add_argument("--keys", type=int, default=100_000)
+    parser.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of key popularity")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("retrieve=80,insert=15,version=5"))
+    parser.add_argument("--value-size", type=int, default=32)
+    parser.add_argument("--check", action="store_true",
+                        help="run the 4test.py suite against the server first")
+    args = parser.parse_args()
+
+    addr = (args.host, args.port)
+    kvtest.ADDR = addr
+    if not kvtest.check_server_availability():
+        print("❌ Server is not reachable at", addr)
+        return False
+    if args.check and not kvtest.run_tests():
+        return False
+
+    mix = ", ".join(f"{kind} {weight:g}" for kind, weight in args.mix.items())
+    print(f"\n{args.concurrency} clients over {args.processes} process(es) for {args.duration:g}s; "
+          f"{args.keys:,} keys, zipf {args.zipf:g}; mix {mix}")
+    workload = {"keys": args.keys, "zipf": args.zipf, "mix": args.mix, "value_size": args.value_size}
+    latencies, inserts, lost = run_load(addr, args.processes, args.concurrency,
+                                        args.duration, args.timeout, workload)
+    print_report(latencies, inserts, lost, args.duration)
+    return True
+
+
+if __name__ == "__main__":
+    exit(0 if main() else 1)
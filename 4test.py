@@ -127,6 +127,29 @@ def test_version_unchanged():
     expected = "version=Ken's Key-Value Store 1.0"
     assert response == expected, f"Expected '{expected}', got '{response}'"
 
+def test_non_utf8_datagram():
+    """Test that a datagram that isn't UTF-8 is stored and served back as bytes."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        sock.sendto(b"\xff=1", ADDR)
+        sock.sendto(b"\xff", ADDR)
+        data, _ = sock.recvfrom(1024)
+    assert data == b"\xff=1", f"Expected b'\\xff=1', got {data!r}"
+
+def test_retrieve_from_other_socket():
+    """Test that a retrieve from a second socket, sent right after an insert, sees it."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as writer, \
+         socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as reader:
+        reader.settimeout(1)
+        stale = 0
+        for i in range(2000):
+            writer.sendto(f"cross={i}".encode(), ADDR)
+            reader.sendto(b"cross", ADDR)
+            data, _ = reader.recvfrom(1024)
+            if data != f"cross={i}".encode():
+                stale += 1
+    assert stale == 0, f"{stale} of 2000 retrieves missed the insert before them"
+
 def run_tests():
     """Run all tests for the UDP key-value store."""
     # Check server availability
@@ -152,6 +175,8 @@ def run_tests():
         ("Retrieve missing key", test_retrieve_missing_key),
         ("Ignore insert to version (version=hack)", test_ignore_version_insert),
         ("Version still unchanged", test_version_unchanged),
+        ("Non-UTF-8 datagram", test_non_utf8_datagram),
+        ("Retrieve from another socket right after insert", test_retrieve_from_other_socket),
     ]
     
     for test_name, test_func in test_cases:
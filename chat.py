@@ -1,37 +1,309 @@
+import argparse
+import asyncio
+import bisect
+import queue
 import socket 
-import sys
 import threading 
+import time
+
+import common
 
 
 
 HOST = '127.0.0.1'
 PORT = 65432
-all_clients = {}
+# Room name -> Room; a room exists while it has members
 room_clients = {}
-
-
-#do not show this to other users but only the new user
-def list_user_names(name):
-    names = []
-    for n,con in all_clients.items():
-        if name != n :
-            names.append(n)
-
-    if len(names) ==0 :
-        return "\n* There is nobody in the room".encode()
-    allnames = ' '.join(n for n in names)
-    return f"\n* the room contains {allnames}".encode()
-    
-def list_only_names_excluding_new_user(name):
-    names = []
-    for n , con in all_clients.items():
-        if name != n :
-            names.append(n)
-
-    if len(names)  ==0 :
-        return 0 
-    
-    return names 
+rooms_lock = threading.Lock()
+# Users who give a bare name instead of name@room end up here
+DEFAULT_ROOM = "lobby"
+
+# Writes (one message, or one batch of a sender's lines) queued for a client of
+# the asyncio server before it is a slow consumer
+OUTBOX_SIZE = 1024
+# What happens to a slow consumer: it misses the messages that don't fit, or is disconnected
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect")
+slow_consumer_policy = "disconnect"
+# Lines a client's burst is broadcast in before the sender tasks get to run
+YIELD_EVERY = 16
+# A partial line longer than this disconnects the client
+MAX_LINE_LENGTH = 1 << 16
+READ_SIZE = 65536
+
+# Set by enable_metrics(); None keeps every instrumentation point to one check
+metrics = None
+STATS_PORT = 0
+# Timed samples (per-recipient send times, queue depths, asyncio fan-out times)
+# are taken every this many batches
+SAMPLE_EVERY = 64
+# A send slower than this, or an outbox deeper than OUTBOX_SIZE // 2, marks a slow client
+SLOW_SEND_US = 100_000
+SLOW_CLIENTS_SHOWN = 20
+HISTOGRAM_BUCKETS = 40
+
+
+class Histogram:
+    """
+    Counts of non-negative integers (microseconds, queue depths) in
+    power-of-two buckets: bucket i holds values below 2**i.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.buckets[min(value.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of values."""
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.max, (1 << i) - 1)
+        return 0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": {f"<{1 << i}": n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class ChatMetrics:
+    """
+    Counters and histograms for one server process. Updates happen per
+    batch of lines, or per sampled batch, never per recipient, and take
+    no lock: under the threaded server a racing increment can get lost,
+    which a metrics view can live with.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.messages_in = 0
+        self.batches_in = 0
+        self.messages_out = 0
+        self.writes_out = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self.fanout_us = Histogram()
+        self.send_us = Histogram()
+        self.queue_depth = Histogram()
+        # (room, name) -> how slow, for members still in the room
+        self.slow_clients = {}
+        self.async_clients = set()
+
+    def delivered(self, lines, recipients, nbytes):
+        self.messages_out += lines * recipients
+        self.writes_out += recipients
+        self.bytes_out += nbytes * recipients
+
+    def snapshot(self):
+        deepest = sorted(((client.outbox.qsize(), f"{client.name}@{client.room_name}")
+                          for client in list(self.async_clients)), reverse=True)[:SLOW_CLIENTS_SHOWN]
+        slowest = sorted(self.slow_clients.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "uptime": time.time() - self.started,
+            "rooms": len(room_clients),
+            "clients": sum(len(room.members) for room in list(room_clients.values())),
+            "messages_in": self.messages_in,
+            "batches_in": self.batches_in,
+            "messages_out": self.messages_out,
+            "writes_out": self.writes_out,
+            "bytes_out": self.bytes_out,
+            "dropped": self.dropped,
+            "slow_disconnects": self.slow_disconnects,
+            "fanout_us": self.fanout_us.snapshot(),
+            "send_us": self.send_us.snapshot(),
+            "queue_depth": self.queue_depth.snapshot(),
+            "outbox_depths": {label: depth for depth, label in deepest},
+            "slow_clients": {f"{name}@{room}": value for (room, name), value in slowest[:SLOW_CLIENTS_SHOWN]},
+        }
+
+
+def enable_metrics():
+    global metrics
+    metrics = ChatMetrics()
+
+
+class Room:
+    """
+    One chat room, independent of every other: its members, a sorted
+    roster and a lock that guards both. members is a tuple of (name,
+    send) pairs, replaced on every join and leave, so a broadcast walks
+    it without taking the lock. A joining user holds a place in the
+    roster before they are a member (see join_room).
+
+    The threaded server publishes to a room, and the room's own fan-out
+    thread does the blocking sends. A stuck reader then stalls only its
+    own room. The asyncio server broadcasts inline, since its sends
+    only queue.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.joining = set()
+        self.roster = []
+        self.members = ()
+        self.outbox = queue.SimpleQueue()
+        self.worker = None
+        self.closed = False
+        self.batches = 0
+
+    def reserve(self, name):
+        """
+        Holds name's place in the roster unless it is taken; returns the
+        room listing as it was before, or None if the name is taken.
+        """
+        with self.lock:
+            if name in self.clients or name in self.joining:
+                return None
+            listing = self.listing()
+            self.joining.add(name)
+            bisect.insort(self.roster, name)
+            return listing
+
+    def admit(self, name, send):
+        """Makes a reserved name a member, who gets the room's messages from now on."""
+        with self.lock:
+            self.joining.discard(name)
+            self.clients[name] = send
+            self.members = tuple(self.clients.items())
+
+    def leave(self, name):
+        """Removes name, a member or still joining; returns True if the room is now empty."""
+        with self.lock:
+            if self.clients.pop(name, None) is not None:
+                self.members = tuple(self.clients.items())
+            elif name in self.joining:
+                self.joining.discard(name)
+            else:
+                return not self.roster
+            del self.roster[bisect.bisect_left(self.roster, name)]
+            return not self.roster
+
+    #do not show this to other users but only the new user
+    def listing(self):
+        if not self.roster:
+            return "* There is nobody in the room\n".encode()
+        allnames = ' '.join(self.roster)
+        return f"* the room contains {allnames}\n".encode()
+
+    def broadcast(self, sender_name, data, lines=1):
+        """Sends one bytes object, built once by the caller, to everyone but the sender."""
+        members = self.members
+        for name, send in members:
+            if name != sender_name:
+                try:
+                    send(data)
+                except OSError:
+                    pass  # that user's own thread sees the connection go and cleans up
+        if metrics is not None:
+            metrics.delivered(lines, len(members) - (sender_name in self.clients), len(data))
+
+    def broadcast_timed(self, sender_name, data, lines=1):
+        """broadcast, timing every blocking send and flagging the slow recipients."""
+        members = self.members
+        send_us = metrics.send_us
+        for name, send in members:
+            if name != sender_name:
+                start = time.perf_counter()
+                try:
+                    send(data)
+                except OSError:
+                    pass
+                elapsed = int((time.perf_counter() - start) * 1e6)
+                send_us.record(elapsed)
+                if elapsed > SLOW_SEND_US:
+                    metrics.slow_clients[self.name, name] = elapsed
+        metrics.delivered(lines, len(members) - (sender_name in self.clients), len(data))
+
+    def publish(self, sender_name, data, lines=1):
+        """Hands data to this room's fan-out thread, starting it if need be."""
+        if self.worker is None:
+            with self.lock:
+                if self.closed:
+                    return
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self.fan_out, daemon=True)
+                    self.worker.start()
+        self.outbox.put((sender_name, data, lines, time.perf_counter() if metrics is not None else 0))
+
+    def fan_out(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            sender_name, data, lines, queued = item
+            if metrics is None:
+                self.broadcast(sender_name, data, lines)
+                continue
+
+            self.batches += 1
+            if self.batches % SAMPLE_EVERY:
+                self.broadcast(sender_name, data, lines)
+            else:
+                metrics.queue_depth.record(self.outbox.qsize())
+                self.broadcast_timed(sender_name, data, lines)
+            metrics.fanout_us.record(int((time.perf_counter() - queued) * 1e6))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.worker is not None:
+                self.outbox.put(None)
+
+
+def join_room(room_name, name, send, greeting=b""):
+    """
+    Joins name to the room, creating it; returns the Room, or None if
+    the name is taken. The new user first gets greeting plus the room
+    listing, and only then the room's messages, so nothing said in the
+    room can reach them before it. The listing is sent with no lock
+    held: a joiner that doesn't read holds up only their own thread.
+    """
+    with rooms_lock:
+        room = room_clients.get(room_name)
+        if room is None:
+            room = room_clients[room_name] = Room(room_name)
+        listing = room.reserve(name)
+        if listing is None:
+            if not room.roster:
+                del room_clients[room_name]
+            return None
+    try:
+        send(greeting + listing)
+    except Exception:
+        leave_room(room, name)
+        raise
+    room.admit(name, send)
+    return room
+
+def leave_room(room, name):
+    """Takes name out of room; an emptied room is closed and forgotten."""
+    if metrics is not None:
+        metrics.slow_clients.pop((room.name, name), None)
+    with rooms_lock:
+        if room.leave(name):
+            room_clients.pop(room.name, None)
+            room.close()
+            return False
+    return True
 
 
 def send_message(name, message):
@@ -39,99 +311,96 @@ def send_message(name, message):
 
 #do not show this to new user but to everyone else in the room
 def user_joins(name):
-    return f"\n* {name} has entered the room".encode()
+    return f"* {name} has entered the room\n".encode()
 
 def user_leaves(name):
-    return f"\n* {name} has left the room".encode()
-
-
-def send_to(addr, message):
-    
-    all_clients[addr].sendall(message)
-    
-
-def send_user_join_message(names, message):
-    if len(names )==0 :
-        return 
-    print("names: ", names)
-    print("message: ", message)
-    
-    for name in names:
-        send_to(name, message)
-
-def register_name(conn):
-    while True:
-        data = conn.recv(1024)
-        if not data:
-            return None  # Client disconnected during name input
-
-        name = data.decode().strip()
-
-        if len(name) > 16:
-            conn.sendall(b"Name is too long, mate. Try another:\n")
-            continue
-
-        if not name.isalnum():
-            conn.sendall(b"Name must be alphanumeric. Try another:\n")
-            continue
-
-        if name in all_clients:
-            conn.sendall(b"Name is taken. Try another:\n")
-            continue
-
-        # Valid name
-        conn.sendall(b"\nYou're in!\n")
-        return name
-
-
-def chat_loop(conn, name):
+    return f"* {name} has left the room\n".encode()
+
+
+def parse_name(line):
+    """'alice@games' -> ('alice', 'games'); a bare name goes to DEFAULT_ROOM."""
+    name, _, room = line.partition('@')
+    return name, room or DEFAULT_ROOM
+
+def check_name(name, room=DEFAULT_ROOM):
+    """Returns the reply for a name or room that can't be used, or None if they can."""
+    if len(name) > 16:
+        return b"Name is too long, mate. Try another:\n"
+    if not name.isalnum():
+        return b"Name must be alphanumeric. Try another:\n"
+    if len(room) > 16 or not room.isalnum():
+        return b"Room must be alphanumeric, at most 16 characters. Try another:\n"
+    return None
+
+def register_name(conn, reader):
+    """
+    Returns (name, room, lines sent after the name) once the user has
+    joined a room, or (None, None, None).
+    """
     while True:
-        data = conn.recv(1024)
-        if not data:
-            break
-        message = f"[{name}] {data.decode().strip()}"
-        broadcast_message(name, message)
-
-def broadcast_message(sender_name, message):
-    for user, conn in all_clients.items():
-        if user != sender_name:
-            conn.sendall(message.encode() + b"\n")
+        lines = reader.recv_lines(conn)
+        if lines is None:
+            return None, None, None  # Client disconnected during name input
+
+        for i, line in enumerate(lines):
+            name, room_name = parse_name(line.decode().strip())
+            error = check_name(name, room_name)
+            if error:
+                conn.sendall(error)
+                continue
+
+            # Valid name; show the room to this user as they join it
+            room = join_room(room_name, name, conn.sendall, b"\nYou're in!\n")
+            if room is None:
+                conn.sendall(b"Name is taken. Try another:\n")
+                continue
+            return name, room, lines[i + 1:]
+
+
+def frame_batch(prefix, lines):
+    """One bytes object holding every line of a batch as a chat message, in order."""
+    return b"".join([prefix + line.strip() + b"\n" for line in lines])
+
+def chat_loop(conn, reader, name, room, lines):
+    prefix = f"[{name}] ".encode()
+    while lines is not None:
+        if lines:
+            room.publish(name, frame_batch(prefix, lines), len(lines))
+            if metrics is not None:
+                metrics.messages_in += len(lines)
+                metrics.batches_in += 1
+        lines = reader.recv_lines(conn)
 
 def handle_client(conn, addr):
     print(f"\nConnected by {addr}")
+    name = room = None
     try:
         conn.sendall(b"\nWelcome to budgetchat! What shall I call you?\n")
-        name = register_name(conn)
+        reader = common.LineReader(MAX_LINE_LENGTH)
+        name, room, lines = register_name(conn, reader)
         if not name:
             return  # Registration failed
 
-        all_clients[name] = conn
-
-        # Notify others about this user
-        message = list_user_names(name)
-        send_to(name, message)
-
-        names_except_user = list_only_names_excluding_new_user(name)
-        user_join_message = user_joins(name)
-        send_user_join_message(names_except_user, user_join_message)
+        # Tell everyone else in the room about this user
+        room.publish(name, user_joins(name))
 
         # Start chat session
-        chat_loop(conn, name)
+        chat_loop(conn, reader, name, room, lines)
 
     except Exception as e:
         print(f"Error with {addr}: {e}")
 
     finally:
-        print("finally():: name : ", name)
-        names_except_user = list_only_names_excluding_new_user(name)
-        message = user_leaves(name)
-        send_user_join_message(names_except_user, message)
-        all_clients.pop(name, None)
+        if room is not None and leave_room(room, name):
+            room.publish(name, user_leaves(name))
         conn.close()
         print(f"Disconnected by {addr}")
 
 
 def start_server():
+    if metrics is not None:
+        threading.Thread(target=common.serve_stats, args=(HOST, STATS_PORT, metrics.snapshot),
+                         daemon=True).start()
     with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as server:
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
         server.bind((HOST, PORT))
@@ -146,6 +415,192 @@ def start_server():
             thread.start()
 
 
+class ChatClient:
+    """
+    A user of the asyncio server. Messages for it wait in a bounded
+    outbox that its own sender task writes out, so a broadcast only
+    queues and never waits on a slow reader.
+    """
+
+    def __init__(self, name, room_name, writer):
+        self.name = name
+        self.room_name = room_name
+        self.writer = writer
+        self.outbox = asyncio.Queue(OUTBOX_SIZE)
+        self.dropped = 0
+        self.closed = False
+        self.sender = asyncio.create_task(self.send_loop())
+
+    async def send_loop(self):
+        outbox, writer = self.outbox, self.writer
+        writes = 0
+        try:
+            while True:
+                batch = [await outbox.get()]
+                while not outbox.empty():
+                    batch.append(outbox.get_nowait())
+                writes += 1
+                if metrics is None or writes % SAMPLE_EVERY:
+                    writer.writelines(batch)
+                else:
+                    self.write_timed(batch)
+                await writer.drain()
+        except ConnectionError:
+            pass  # the reading side sees the connection go and cleans up
+
+    def write_timed(self, batch):
+        """writelines, recording its time and how deep the outbox had got."""
+        start = time.perf_counter()
+        self.writer.writelines(batch)
+        metrics.send_us.record(int((time.perf_counter() - start) * 1e6))
+        metrics.queue_depth.record(len(batch))
+        if len(batch) > OUTBOX_SIZE // 2:
+            metrics.slow_clients[self.room_name, self.name] = len(batch)
+
+    def send(self, data):
+        """Queues data without waiting. A full outbox applies slow_consumer_policy."""
+        if self.closed:
+            return
+        try:
+            self.outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            if slow_consumer_policy == "drop":
+                self.dropped += 1
+                if metrics is not None:
+                    metrics.dropped += 1
+            else:
+                print(f"Disconnecting slow consumer {self.name}")
+                if metrics is not None:
+                    metrics.slow_disconnects += 1
+                    metrics.slow_clients[self.room_name, self.name] = OUTBOX_SIZE
+                self.disconnect()
+
+    def disconnect(self):
+        self.closed = True
+        self.sender.cancel()
+        self.writer.transport.abort()
+
+def broadcast_batch(room, name, data, lines):
+    """
+    The asyncio server's broadcast of one batch of a client's lines:
+    counted, and timed one batch in SAMPLE_EVERY.
+    """
+    if metrics is None:
+        room.broadcast(name, data, lines)
+        return
+    metrics.messages_in += lines
+    metrics.batches_in += 1
+    if metrics.batches_in % SAMPLE_EVERY:
+        room.broadcast(name, data, lines)
+    else:
+        start = time.perf_counter()
+        room.broadcast(name, data, lines)
+        metrics.fanout_us.record(int((time.perf_counter() - start) * 1e6))
+
+async def handle_client_async(reader, writer):
+    addr = writer.get_extra_info('peername')
+    print(f"\nConnected by {addr}")
+    client = room = None
+    framer = common.LineReader(MAX_LINE_LENGTH)
+    lines = []
+    try:
+        writer.write(b"\nWelcome to budgetchat! What shall I call you?\n")
+        while room is None:
+            while not lines:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return  # Client disconnected during name input
+                lines = framer.feed(data)
+            name, room_name = parse_name(lines.pop(0).decode().strip())
+            error = check_name(name, room_name)
+            if error:
+                writer.write(error)
+                continue
+            client = ChatClient(name, room_name, writer)
+            room = join_room(room_name, name, client.send, b"\nYou're in!\n")
+            if room is None:
+                client.sender.cancel()
+                client = None
+                writer.write(b"Name is taken. Try another:\n")
+        if metrics is not None:
+            metrics.async_clients.add(client)
+
+        room.broadcast(name, user_joins(name))
+
+        prefix = f"[{name}] ".encode()
+        handled = 0
+        while True:
+            if lines:
+                broadcast_batch(room, name, frame_batch(prefix, lines), len(lines))
+                handled += len(lines)
+                if handled >= YIELD_EVERY:
+                    # A burst is read from the buffer without suspending; let the outboxes drain
+                    handled = 0
+                    await asyncio.sleep(0)
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            lines = framer.feed(data)
+
+    except Exception as e:
+        print(f"Error with {addr}: {e}")
+
+    finally:
+        if client is not None:
+            client.closed = True
+            client.sender.cancel()
+            if metrics is not None:
+                metrics.async_clients.discard(client)
+        if room is not None and leave_room(room, name):
+            room.broadcast(name, user_leaves(name))
+        writer.close()
+        print(f"Disconnected by {addr}")
+
+
+async def start_async_server():
+    server = await asyncio.start_server(handle_client_async, HOST, PORT, reuse_address=True)
+    print(f"Server listening on {HOST}:{PORT} (asyncio, slow consumers: {slow_consumer_policy})")
+    stats_server = None
+    if metrics is not None:
+        stats_server = await common.start_stats_server(HOST, STATS_PORT, metrics.snapshot)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if stats_server is not None:
+            stats_server.close()
+
+
+def main():
+    global PORT, OUTBOX_SIZE, slow_consumer_policy, STATS_PORT
+
+    parser = argparse.ArgumentParser(description="Budget Chat server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with asyncio instead of one thread per client")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--outbox-size", type=int, default=OUTBOX_SIZE,
+                        help="writes queued per client before it counts as slow (asyncio)")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=slow_consumer_policy)
+    parser.add_argument("--stats-port", type=int, default=STATS_PORT,
+                        help="collect metrics and serve them on this local port (0: off). "
+                             "Send 'json' for JSON, any other line for text")
+    args = parser.parse_args()
+
+    PORT = args.port
+    OUTBOX_SIZE = args.outbox_size
+    slow_consumer_policy = args.slow_consumer
+    if args.stats_port:
+        STATS_PORT = args.stats_port
+        enable_metrics()
+    if args.use_async:
+        try:
+            asyncio.run(start_async_server())
+        except KeyboardInterrupt:
+            pass
+    else:
+        start_server()
+
+
 if __name__ =='__main__':
-    start_server()
+    main()
 
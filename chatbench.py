@@ -0,0 +1,477 @@
+import asyncio
+import json
+import socket
+import statistics
+import time
+import tracemalloc
+
+import chat
+import common
+
+HOST = "127.0.0.1"
+BENCH_PORT = 65499
+STATS_PORT = 65498
+USER_COUNTS = [100, 1000, 5000]
+SENDERS = 10
+# Roughly this many deliveries are timed at every room size
+DELIVERIES = 1_000_000
+# Users connect in waves of this many, so the join notices never pile up
+JOIN_WAVE = 100
+# Slow-reader runs: a small room, big messages, one user that stops reading
+SLOW_USERS = 20
+SLOW_MESSAGES = 5000
+SLOW_PAYLOAD = b"x" * 200
+# Rooms runs: this many users per room, one of them sending
+ROOM_COUNTS = [10, 50, 200]
+ROOM_USERS = 20
+# Quiet rooms probed for latency while another room is flooded
+QUIET_ROOMS = 20
+PROBES = 10
+# Metrics overhead runs: one room this big, longer bursts than fanout's, best of this many runs each way
+METRICS_USERS = 1000
+METRICS_DELIVERIES = 5_000_000
+METRICS_RUNS = 6
+IN_PROCESS_RUNS = 100
+SOCKET_RECIPIENTS = 200
+# Small enough that no socket buffer fills before the peers are drained
+FAN_OUT_BATCHES = 50
+# Batches per run through asyncio clients' outboxes; fewer than OUTBOX_SIZE
+ASYNC_BATCHES = 200
+
+
+class BenchUser(asyncio.Protocol):
+    """A chat user that only counts the lines it receives."""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.counter[0] += data.count(b"\n")
+
+
+class ProbeUser(asyncio.Protocol):
+    """A chat user whose next line completes the waiter future."""
+
+    def __init__(self):
+        self.transport = None
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(time.perf_counter())
+
+
+def start_server(*args, port=BENCH_PORT):
+    return common.start_process("chat.py", "--port", str(port), *args, port=port)
+
+
+async def settle(counter, quiet=0.3, limit=60.0):
+    """Waits until no line has arrived for quiet seconds."""
+    end = time.perf_counter() + limit
+    last = -1
+    while counter[0] != last and time.perf_counter() < end:
+        last = counter[0]
+        await asyncio.sleep(quiet)
+
+
+async def wait_for_lines(counter, target, stall=3.0):
+    """
+    Waits for counter to reach target, giving up after stall seconds
+    without progress. Returns when the last line arrived.
+    """
+    last, last_change = counter[0], time.perf_counter()
+    while counter[0] < target:
+        await asyncio.sleep(0.01)
+        if counter[0] != last:
+            last, last_change = counter[0], time.perf_counter()
+        elif time.perf_counter() - last_change > stall:
+            break
+    return last_change
+
+
+async def join_users(port, names, counter):
+    """Connects and names a BenchUser per name, in waves; returns their transports."""
+    loop = asyncio.get_running_loop()
+    connections = []
+    for wave in range(0, len(names), JOIN_WAVE):
+        for name in names[wave:wave + JOIN_WAVE]:
+            transport, _ = await loop.create_connection(lambda: BenchUser(counter), HOST, port)
+            transport.write(name + b"\n")
+            connections.append(transport)
+        await settle(counter, quiet=0.1)
+    await settle(counter)
+    return connections
+
+
+async def run_room(port, users, senders, messages, payload=b"", stuck=0):
+    """
+    Returns (lines delivered, expected deliveries, seconds) for one timed
+    burst. The last stuck users stop reading before the burst; nothing
+    is expected for them.
+    """
+    counter = [0]
+    connections = await join_users(port, [b"user%d" % i for i in range(users)], counter)
+    for transport in connections[users - stuck:]:
+        transport.pause_reading()
+
+    baseline = counter[0]
+    expected = senders * messages * (users - 1 - stuck)
+    start = time.perf_counter()
+    for s, transport in enumerate(connections[:senders]):
+        transport.write(b"".join(b"message %d from sender %d %s\n" % (m, s, payload)
+                                 for m in range(messages)))
+    end = await wait_for_lines(counter, baseline + expected)
+    delivered = counter[0] - baseline
+
+    for transport in connections:
+        transport.abort()
+    return delivered, expected, end - start
+
+
+def print_run(label, users, messages, delivered, expected, elapsed):
+    note = "" if delivered >= expected else f" ({expected - delivered:,} missing)"
+    print(f"{label:>20} {users:>6} {messages:>9} {delivered:>11,} {elapsed:>8.2f} "
+          f"{delivered / elapsed:>12,.0f}{note}")
+
+
+def bench_fanout(user_counts=USER_COUNTS, senders=SENDERS):
+    """Messages/sec each server delivers to every other user as the room grows."""
+    print(f"chat fan-out, {senders} senders bursting; ~{DELIVERIES:,} deliveries per run")
+    print(f"{'server':>20} {'users':>6} {'messages':>9} {'delivered':>11} {'seconds':>8} {'delivered/s':>12}")
+    for users in user_counts:
+        messages = max(1, DELIVERIES // (senders * (users - 1)))
+        for label, args in (("threads", []), ("asyncio", ["--async"])):
+            server = start_server(*args)
+            try:
+                result = asyncio.run(run_room(BENCH_PORT, users, senders, messages))
+            finally:
+                common.stop_process(server)
+            print_run(label, users, senders * messages, *result)
+
+
+def bench_slow_reader(senders=SENDERS):
+    """Deliveries to the healthy users of a room with one user that never reads."""
+    print(f"\none stuck reader in a room of {SLOW_USERS}, {senders} senders x {SLOW_MESSAGES} "
+          f"{len(SLOW_PAYLOAD)}-byte messages")
+    print(f"{'server':>20} {'users':>6} {'messages':>9} {'delivered':>11} {'seconds':>8} {'delivered/s':>12}")
+    modes = [("threads", [])] + [(f"asyncio, {policy}", ["--async", "--slow-consumer", policy])
+                                 for policy in ("disconnect", "drop")]
+    for label, args in modes:
+        server = start_server(*args)
+        try:
+            result = asyncio.run(run_room(BENCH_PORT, SLOW_USERS, senders, SLOW_MESSAGES,
+                                          payload=SLOW_PAYLOAD, stuck=1))
+        finally:
+            common.stop_process(server)
+        print_run(label, SLOW_USERS, senders * SLOW_MESSAGES, *result)
+
+
+class FakeRecipient:
+    """
+    Stands in for a socket (sendall) or a ChatClient (send). Keeps what
+    it is given in a preallocated list, so only payloads get allocated.
+    """
+
+    def __init__(self, capacity):
+        self.received = [None] * capacity
+        self.count = 0
+
+    def sendall(self, data):
+        self.received[self.count] = data
+        self.count += 1
+
+    send = sendall
+
+
+class NullRecipient:
+    def sendall(self, data):
+        pass
+
+    send = sendall
+
+
+def broadcast_per_recipient(room, sender_name, message):
+    """What broadcasting used to do: encode the message again for every recipient."""
+    for user, send in room.members:
+        if user != sender_name:
+            send(message.encode() + b"\n")
+
+
+class NullWriter:
+    """A StreamWriter stand-in that takes every write at once."""
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+async def make_null_clients(count):
+    return [chat.ChatClient(f"user{i}", "bench", NullWriter()) for i in range(count)]
+
+
+def fill_room(recipients):
+    room = chat.Room("bench")
+    room.clients = {f"user{i}": recipient.send for i, recipient in enumerate(recipients)}
+    room.members = tuple(room.clients.items())
+    return room
+
+
+def bench_broadcast_allocations(recipients=1000, broadcasts=200):
+    """Payload buffers and bytes allocated per broadcast, and time per broadcast."""
+    print(f"\nbroadcast to {recipients} recipients, {broadcasts} broadcasts")
+    line = b"x" * 60 + b"\n"
+    prefix = b"[alice] "
+    cases = [
+        ("encode per recipient",
+         lambda room: broadcast_per_recipient(room, "alice", f"[alice] {line.decode().strip()}")),
+        ("Room.broadcast", lambda room: room.broadcast("alice", prefix + line.strip() + b"\n")),
+    ]
+    print(f"{'':>20} {'buffers':>8} {'bytes allocated':>16} {'time':>9}")
+    for label, broadcast in cases:
+        fakes = [FakeRecipient(broadcasts) for _ in range(recipients)]
+        room = fill_room(fakes)
+        tracemalloc.start()
+        for _ in range(broadcasts):
+            broadcast(room)
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        buffers = sum(len({id(fake.received[k]) for fake in fakes}) for k in range(broadcasts))
+        del fakes, room
+
+        room = fill_room([NullRecipient() for _ in range(recipients)])
+        start = time.perf_counter()
+        for _ in range(broadcasts):
+            broadcast(room)
+        elapsed = (time.perf_counter() - start) / broadcasts
+
+        print(f"{label:>20} {buffers / broadcasts:>8.0f} {allocated / broadcasts:>16,.0f} "
+              f"{elapsed * 1e6:>7.0f}us")
+
+
+async def run_rooms(port, rooms, users, messages):
+    """
+    Like run_room, over rooms rooms of users users each, with the first
+    user of every room bursting at once.
+    """
+    counter = [0]
+    names = [b"user%d@room%d" % (i, r) for r in range(rooms) for i in range(users)]
+    connections = await join_users(port, names, counter)
+
+    baseline = counter[0]
+    expected = rooms * messages * (users - 1)
+    start = time.perf_counter()
+    for transport in connections[::users]:
+        transport.write(b"".join(b"message %d\n" % m for m in range(messages)))
+    end = await wait_for_lines(counter, baseline + expected)
+    delivered = counter[0] - baseline
+
+    for transport in connections:
+        transport.abort()
+    return delivered, expected, end - start
+
+
+async def probe_quiet_rooms(port, quiet_rooms, probes, senders):
+    """
+    Floods one room, which has a user that stopped reading, from senders
+    users while a speaker in each of quiet_rooms other rooms says one
+    line at a time. Returns the sorted seconds each line took to reach
+    the listener in its room, and the lines that never did.
+    """
+    loop = asyncio.get_running_loop()
+    counter = [0]
+    busy = await join_users(port, [b"user%d@busy" % i for i in range(SLOW_USERS)], counter)
+    busy[-1].pause_reading()
+
+    pairs = []
+    for r in range(quiet_rooms):
+        speaker, _ = await loop.create_connection(asyncio.Protocol, HOST, port)
+        speaker.write(b"speaker@quiet%d\n" % r)
+        listener, probe = await loop.create_connection(ProbeUser, HOST, port)
+        listener.write(b"listener@quiet%d\n" % r)
+        pairs.append((speaker, listener, probe))
+    await asyncio.sleep(0.5)
+
+    burst = b"".join(b"message %d %s\n" % (m, SLOW_PAYLOAD) for m in range(SLOW_MESSAGES))
+    for transport in busy[:senders]:
+        transport.write(burst)
+    await asyncio.sleep(0.2)  # let the stuck reader's buffers fill
+
+    latencies = []
+    lost = 0
+    for _ in range(probes):
+        for speaker, _, probe in pairs:
+            probe.waiter = loop.create_future()
+            sent = time.perf_counter()
+            speaker.write(b"ping\n")
+            try:
+                latencies.append(await asyncio.wait_for(probe.waiter, 2.0) - sent)
+            except asyncio.TimeoutError:
+                lost += 1
+
+    for transport in busy:
+        transport.abort()
+    for speaker, listener, _ in pairs:
+        speaker.abort()
+        listener.abort()
+    return sorted(latencies), lost
+
+
+def bench_rooms(room_counts=ROOM_COUNTS, users=ROOM_USERS, senders=SENDERS):
+    """
+    Aggregate fan-out over many concurrent rooms (asyncio only, as in
+    bench_fanout), then how long a quiet room waits while another room
+    is flooded past a stuck reader.
+    """
+    print(f"\nmany rooms, {users} users each, one sender per room; ~{DELIVERIES:,} deliveries per run")
+    print(f"{'server':>20} {'rooms':>6} {'messages':>9} {'delivered':>11} {'seconds':>8} {'delivered/s':>12}")
+    for rooms in room_counts:
+        messages = max(1, DELIVERIES // (rooms * (users - 1)))
+        server = start_server("--async")
+        try:
+            result = asyncio.run(run_rooms(BENCH_PORT, rooms, users, messages))
+        finally:
+            common.stop_process(server)
+        print_run("asyncio", rooms, rooms * messages, *result)
+
+    print(f"\n{QUIET_ROOMS} quiet rooms x {PROBES} lines while a room of {SLOW_USERS} with a "
+          f"stuck reader takes {senders} x {SLOW_MESSAGES} {len(SLOW_PAYLOAD)}-byte messages")
+    print(f"{'server':>20} {'p50':>9} {'p99':>9} {'max':>9} {'lost':>5}")
+    for label, args in (("threads", []), ("asyncio, disconnect", ["--async"]),
+                        ("asyncio, drop", ["--async", "--slow-consumer", "drop"])):
+        server = start_server(*args)
+        try:
+            latencies, lost = asyncio.run(probe_quiet_rooms(BENCH_PORT, QUIET_ROOMS, PROBES, senders))
+        finally:
+            common.stop_process(server)
+        if latencies:
+            p50 = common.percentile(latencies, 0.5)
+            p99 = common.percentile(latencies, 0.99)
+            print(f"{label:>20} {p50 * 1e3:>7.2f}ms {p99 * 1e3:>7.2f}ms "
+                  f"{latencies[-1] * 1e3:>7.2f}ms {lost:>5}")
+        else:
+            print(f"{label:>20} {'-':>9} {'-':>9} {'-':>9} {lost:>5}")
+
+
+def fetch_stats(port=STATS_PORT):
+    """Asks a chat server's stats socket for its JSON snapshot."""
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(b"json\n")
+        reply = b""
+        while data := sock.recv(65536):
+            reply += data
+    return json.loads(reply)
+
+
+def bench_metrics(users=METRICS_USERS, senders=SENDERS, runs=METRICS_RUNS):
+    """
+    What --stats-port costs. In process first: Room.broadcast, the
+    asyncio path's broadcast_batch and send loops, and a room's fan_out
+    over real sockets. Then whole servers, whose runs vary by several
+    percent on their own.
+    """
+    print("\nmetrics overhead")
+    data = b"[alice] " + b"x" * 60 + b"\n"
+    room = fill_room([NullRecipient() for _ in range(users)])
+
+    def broadcasts():
+        for _ in range(1000):
+            room.broadcast("alice", data)
+
+    loop = asyncio.new_event_loop()
+    clients = loop.run_until_complete(make_null_clients(users))
+    client_room = fill_room(clients)
+
+    async def batches():
+        for _ in range(ASYNC_BATCHES):
+            chat.broadcast_batch(client_room, "alice", data, 1)
+        # Let every sender task write its outbox out
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    def async_batches():
+        loop.run_until_complete(batches())
+
+    pairs = [socket.socketpair() for _ in range(SOCKET_RECIPIENTS)]
+    socket_room = chat.Room("bench")
+    socket_room.clients = {f"user{i}": sock.sendall for i, (sock, _) in enumerate(pairs)}
+    socket_room.members = tuple(socket_room.clients.items())
+
+    def fan_out():
+        for _ in range(FAN_OUT_BATCHES):
+            socket_room.outbox.put(("alice", data, 1, time.perf_counter()))
+        socket_room.outbox.put(None)
+        socket_room.fan_out()
+        for _, peer in pairs:
+            while len(peer.recv(1 << 20)) == 1 << 20:
+                pass
+
+    for label, work in ((f"Room.broadcast, {users} null recipients x 1000", broadcasts),
+                        (f"broadcast_batch + send loops, {users} ChatClients x {ASYNC_BATCHES}",
+                         async_batches),
+                        (f"Room.fan_out, {SOCKET_RECIPIENTS} sockets x {FAN_OUT_BATCHES}", fan_out)):
+        # Interleave off and on runs, swapping which goes first, so neither gains from
+        # order; the median of each pair's ratio shrugs off the machine's slow spells
+        timings = {False: float("inf"), True: float("inf")}
+        ratios = []
+        for i in range(IN_PROCESS_RUNS):
+            pair = {}
+            for enabled in ((False, True) if i % 2 else (True, False)):
+                chat.metrics = chat.ChatMetrics() if enabled else None
+                start = time.perf_counter()
+                work()
+                pair[enabled] = time.perf_counter() - start
+                timings[enabled] = min(timings[enabled], pair[enabled])
+            ratios.append(pair[True] / pair[False])
+        chat.metrics = None
+        print(f"{label}: off {timings[False] * 1e3:.1f}ms, on {timings[True] * 1e3:.1f}ms "
+              f"(median of paired runs {statistics.median(ratios) - 1:+.2%})")
+    for sock, peer in pairs:
+        sock.close()
+        peer.close()
+    for client in clients:
+        client.sender.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    messages = max(1, METRICS_DELIVERIES // (senders * (users - 1)))
+    print(f"{'server':>20} {'metrics':>8} {'best delivered/s':>17} {'overhead':>9}")
+    for label, args in (("threads", []), ("asyncio", ["--async"])):
+        rates = {False: 0.0, True: 0.0}
+        for i in range(runs):
+            for enabled in ((False, True) if i % 2 else (True, False)):
+                extra = ["--stats-port", str(STATS_PORT)] if enabled else []
+                server = start_server(*args, *extra)
+                try:
+                    delivered, _, elapsed = asyncio.run(run_room(BENCH_PORT, users, senders, messages))
+                    if enabled:
+                        stats = fetch_stats()
+                finally:
+                    common.stop_process(server)
+                rates[enabled] = max(rates[enabled], delivered / elapsed)
+        print(f"{label:>20} {'off':>8} {rates[False]:>17,.0f}")
+        print(f"{label:>20} {'on':>8} {rates[True]:>17,.0f} {rates[True] / rates[False] - 1:>+9.2%}")
+        print(f"{'':>20} last run: {stats['messages_in']:,} in, {stats['messages_out']:,} out, "
+              f"fan-out p50 {stats['fanout_us']['p50']}us p99 {stats['fanout_us']['p99']}us, "
+              f"send p99 {stats['send_us']['p99']}us, queue depth p99 {stats['queue_depth']['p99']}")
+
+
+BENCHES = {
+    "fanout": bench_fanout,
+    "slow-reader": bench_slow_reader,
+    "allocations": bench_broadcast_allocations,
+    "rooms": bench_rooms,
+    "metrics": bench_metrics,
+}
+
+if __name__ == "__main__":
+    for name in common.parse_names("Budget Chat benchmarks", BENCHES, "BENCH", "benches to run"):
+        BENCHES[name]()
@@ -0,0 +1,99 @@
+import importlib
+import time
+
+import chat
+import common
+from mobtest import ChatUser
+
+kvtest = importlib.import_module("4test")
+
+PORT = 65488
+MODES = {
+    "threads": [],
+    "async": ["--async"],
+}
+
+
+def join(name, room):
+    return ChatUser(PORT, name + b"@" + room)
+
+
+def test_line_split_across_sends():
+    alice = join(b"alice", b"split")
+    bob = join(b"bob", b"split")
+    alice.expect(b"bob has entered")
+    bob.send(b"hel")
+    time.sleep(0.2)
+    bob.send(b"lo\n")
+    line = alice.readline()
+    assert line == b"[bob] hello", f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_two_lines_in_one_send():
+    alice = join(b"alice", b"pair")
+    bob = join(b"bob", b"pair")
+    alice.expect(b"bob has entered")
+    bob.send(b"one\ntwo\n")
+    lines = [alice.readline(), alice.readline()]
+    assert lines == [b"[bob] one", b"[bob] two"], f"Got {lines!r}"
+    alice.close()
+    bob.close()
+
+def test_long_line_disconnects():
+    alice = join(b"alice", b"long")
+    bob = join(b"bob", b"long")
+    alice.expect(b"bob has entered")
+    bob.send(b"x" * (chat.MAX_LINE_LENGTH + 1))
+    try:
+        while bob.sock.recv(4096):
+            pass
+    except ConnectionResetError:
+        pass
+    line = alice.readline()
+    assert line == b"* bob has left the room", f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_rooms_isolated():
+    """Joins, messages and names stay in their room; alice can be in both."""
+    alice = join(b"alice", b"red")
+    bob = join(b"bob", b"blue")
+    assert bob.listing == b"* There is nobody in the room", f"Got {bob.listing!r}"
+    other_alice = join(b"alice", b"blue")
+    assert other_alice.listing == b"* the room contains bob", f"Got {other_alice.listing!r}"
+    carol = join(b"carol", b"red")
+    alice.expect(b"carol has entered")
+
+    carol.send(b"red only\n")
+    other_alice.send(b"blue only\n")
+    line = alice.readline()
+    assert line == b"[carol] red only", f"Got {line!r}"
+    lines = [bob.readline(), bob.readline()]
+    assert lines == [b"* alice has entered the room", b"[alice] blue only"], f"Got {lines!r}"
+    for user in (alice, bob, other_alice, carol):
+        user.close()
+
+
+def run_tests(mode):
+    print(f"🚀 Starting Budget Chat Tests ({mode})\n")
+    server = common.start_process("chat.py", *MODES[mode], "--port", str(PORT), port=PORT)
+    try:
+        runner = kvtest.TestRunner()
+        test_cases = [
+            ("Line split across two sends", test_line_split_across_sends),
+            ("Two lines in one send", test_two_lines_in_one_send),
+            ("Over-long line disconnects", test_long_line_disconnects),
+            ("name@room isolation", test_rooms_isolated),
+        ]
+        for test_name, test_func in test_cases:
+            runner.test(test_name, test_func)
+        return runner.print_summary()
+    finally:
+        common.stop_process(server)
+
+
+if __name__ == "__main__":
+    modes = common.parse_names("Tests for chat.py", MODES, "MODE", "serving modes to test")
+    results = [run_tests(mode) for mode in modes]
+    exit(0 if all(results) else 1)
@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+def format_stats(stats, prefix=""):
+    """Flattens a snapshot into 'name value' lines."""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            lines += format_stats(value, f"{prefix}{key}.")
+        elif isinstance(value, float):
+            lines.append(f"{prefix}{key} {value:.3f}")
+        else:
+            lines.append(f"{prefix}{key} {value}")
+    return lines
+
+def stats_reply(request, snapshot):
+    """
+    A stats socket's answer to one request line: 'json', or anything
+    else for text. snapshot() returns the stats as a dict.
+    """
+    stats = snapshot()
+    if request.strip() == b"json":
+        return json.dumps(stats).encode() + b"\n"
+    return "\n".join(format_stats(stats)).encode() + b"\n"
+
+def serve_stats(host, port, snapshot):
+    """Answers stats requests on port, for a threaded server."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    conn.settimeout(1.0)
+                    conn.sendall(stats_reply(conn.recv(64), snapshot))
+                except OSError:
+                    pass
+
+async def start_stats_server(host, port, snapshot):
+    """Answers stats requests on port, for an asyncio server; returns the Server."""
+    async def handle_stats(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 1.0)
+            writer.write(stats_reply(request, snapshot))
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_stats, host, port, reuse_address=True)
+
+
+class LineReader:
+    """
+    Newline framing for a bytes stream. Data is received into one
+    reusable buffer and each batch of complete lines is sliced out in a
+    single pass; only the trailing partial line stays buffered.
+    """
+
+    def __init__(self, max_line, bufsize=65536):
+        self.max_line = max_line
+        self.pending = bytearray()
+        self.recv_buf = bytearray(bufsize)
+        self.recv_view = memoryview(self.recv_buf)
+
+    def feed(self, data):
+        """
+        Appends data and returns the complete lines it finished, without
+        their newlines. Raises ValueError if the partial line left over
+        outgrows max_line.
+        """
+        pending = self.pending
+        scanned = len(pending)
+        pending += data
+
+        end = pending.rfind(b'\n', scanned)
+        if end == -1:
+            lines = []
+        else:
+            lines = pending[:end].split(b'\n')
+            del pending[:end + 1]
+        if len(pending) > self.max_line:
+            raise ValueError("line too long")
+        return lines
+
+    def recv_lines(self, sock):
+        """Receives once from sock; returns the complete lines, or None at EOF."""
+        n = sock.recv_into(self.recv_buf)
+        if n == 0:
+            return None
+        return self.feed(self.recv_view[:n])
+
+
+def parse_names(description, names, metavar, help):
+    """
+    Parses a command line that lists some of names, for a script that
+    runs its benches or test modes by name; none listed means all.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("names", nargs="*", metavar=metavar,
+                        help=f"{help} (default: all; one of {', '.join(names)})")
+    chosen = parser.parse_args().names
+    unknown = [name for name in chosen if name not in names]
+    if unknown:
+        parser.error(f"unknown {metavar.lower()}: {', '.join(unknown)}")
+    return chosen or list(names)
+
+
+def percentile(ordered, fraction):
+    """The value a fraction of the way through an ascending sequence, e.g. 0.99 for p99."""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def wait_for_port(port, host="127.0.0.1", udp=False, process=None, timeout=10.0):
+    """
+    Waits until port takes a TCP connection or, with udp, answers an
+    empty datagram. Raises RuntimeError if process exits first, and
+    TimeoutError after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if udp:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.settimeout(0.1)
+                    sock.connect((host, port))
+                    sock.send(b"")
+                    sock.recv(1024)
+            else:
+                socket.create_connection((host, port), timeout=0.1).close()
+            return
+        except OSError:
+            pass
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args[1:])} exited with {process.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"nothing serving {host}:{port} after {timeout}s")
+        time.sleep(0.02)
+
+def start_process(*args, port, udp=False):
+    """
+    Runs a Python script with args in its own session, output discarded,
+    and returns the Popen once it serves port (see wait_for_port).
+    """
+    process = subprocess.Popen(
+        [sys.executable, *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        wait_for_port(port, udp=udp, process=process)
+    except BaseException:
+        stop_process(process)
+        raise
+    return process
+
+def stop_process(process):
+    """Kills a start_process() process and everything it started, such as pool workers."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # it exited, and nothing it started is left
+    process.wait()
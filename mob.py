@@ -1,67 +1,467 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import re
 import socket
 import threading
+import time
+
+import common
 
 tony_address = b'7YWHMfk9JZe0LM0g1ZauHuiSxhI'
 UPSTREAM_HOST = 'chat.protohackers.com'
 UPSTREAM_PORT = 16963
+# Upstream servers in use, and how each client is given one
+upstreams = []
+UPSTREAM_POLICIES = ("round-robin", "least-connections")
+upstream_policy = "round-robin"
+upstream_turn = itertools.count()
+active_lock = threading.Lock()
+# Idle connections dialed ahead of time per upstream (0: dial on accept)
+POOL_SIZE = 0
+# Seconds the pool waits after a failed dial before trying again
+POOL_RETRY = 1.0
 HOST = '127.0.0.1'
 PORT = 12345
+READ_SIZE = 65536
+# A partial line longer than this closes the connection
+MAX_LINE_LENGTH = 1 << 16
+# Port answering with per-stage timings (0: off)
+STATS_PORT = 0
+
+# A Boguscoin address: '7' then 25-34 more alphanumerics, a whole word
+# between spaces or the ends of a line. The literal '7' comes first so
+# the regex engine can skip ahead to it; the lookbehind then checks
+# what precedes it.
+BOGUS_ADDRESS = re.compile(rb'7(?<![^ \n]7)[A-Za-z0-9]{25,34}(?![^ \n])')
+
+
+def find(block, sub):
+    """
+    block.find(sub) for any block a stage passes on. memoryviews have no
+    find(); the ones stages pass on start at the start of their object,
+    whose own find() is then used.
+    """
+    if isinstance(block, memoryview):
+        return block.obj.find(sub, 0, block.nbytes)
+    return block.find(sub)
+
+
+class StageStats:
+    """
+    Totals for one '<direction>.<stage name>' label in stage_stats: the
+    process() calls, the bytes passed in and the nanoseconds spent, over
+    every connection. Pipeline adds to them after each call; they are
+    read only when the stats port asks for stage_snapshot().
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes_in = 0
+        self.ns = 0
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "bytes_in": self.bytes_in,
+            "ms": self.ns / 1e6,
+            "ns_per_byte": self.ns / self.bytes_in if self.bytes_in else 0.0,
+        }
+
+
+class Stage:
+    """
+    One streaming transform in a direction's pipeline. process() takes a
+    bytes-like block and returns one, possibly empty; flush() returns
+    whatever is held back, at end of stream. A memoryview a stage
+    returns must start at the start of its object (see find). A stage
+    that wants the stream slowed down sets delay, in seconds.
+    """
+
+    name = "stage"
+    delay = 0.0
+
+    def process(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class LineFramer(Stage):
+    """
+    Passes on complete lines only; a trailing partial line is carried
+    over to the next read, so later stages never see a line split
+    across reads. Blocks are passed on uncopied where they can be.
+
+    process() takes reads from elsewhere and carries over in a bytearray.
+    reserve() and commit() receive into one reused buffer instead, and
+    keep the partial line at the front of it, so framing allocates
+    nothing. Use one or the other on a given framer.
+    """
+
+    name = "lines"
+
+    def __init__(self, max_line=MAX_LINE_LENGTH):
+        self.max_line = max_line
+        self.carry = bytearray()
+        self.recv_buf = None
+        # Lines up to start were handed out; start:filled is the partial line
+        self.start = self.filled = 0
+
+    def process(self, data):
+        """
+        Returns the complete lines that data finishes (possibly empty).
+        Raises ValueError if the carried-over partial line outgrows
+        max_line.
+        """
+        end = data.rfind(b'\n') + 1
+        if not end:
+            self.carry += data
+            if len(self.carry) > self.max_line:
+                raise ValueError("line too long")
+            return b""
+
+        if self.carry:
+            block = self.carry
+            block += memoryview(data)[:end]
+            self.carry = bytearray(memoryview(data)[end:])
+        else:
+            block = data if end == len(data) else memoryview(data)[:end]
+            self.carry += memoryview(data)[end:]
+        if len(self.carry) > self.max_line:
+            raise ValueError("line too long")
+        return block
+
+    def reserve(self):
+        """
+        The free end of the receive buffer, to recv_into(). Raises
+        ValueError if a partial line fills the buffer.
+        """
+        if self.recv_buf is None:
+            self.recv_buf = bytearray(self.max_line)
+            self.recv_view = memoryview(self.recv_buf)
+        if self.start:
+            # Move the partial line to the front, now the lines before it are sent
+            kept = self.filled - self.start
+            self.recv_view[:kept] = self.recv_view[self.start:self.filled]
+            self.start, self.filled = 0, kept
+        if self.filled == len(self.recv_buf):
+            raise ValueError("line too long")
+        return self.recv_view[self.filled:]
+
+    def commit(self, n):
+        """
+        Takes n bytes received into reserve() and returns the complete
+        lines they finish, as a view of the buffer valid until the next
+        reserve(), or b"".
+        """
+        scanned = self.filled
+        self.filled += n
+        end = self.recv_buf.rfind(b'\n', scanned, self.filled) + 1
+        if not end:
+            return b""
+        self.start = end
+        return self.recv_view[:end]
+
+    def flush(self):
+        if self.filled:
+            block = bytes(self.recv_view[self.start:self.filled])
+            self.start = self.filled = 0
+        else:
+            block, self.carry = self.carry, bytearray()
+        return block
+
+
+class RegexRewrite(Stage):
+    """
+    Replaces every match of pattern in each block. Put it after a
+    LineFramer if a match can be split across reads. Blocks without
+    hint, a byte string every match contains, skip the regex.
+    """
+
+    def __init__(self, pattern, replacement, hint=None, name="rewrite"):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.hint = hint
+        self.name = name
+
+    def process(self, block):
+        if self.hint is not None and find(block, self.hint) == -1:
+            return block
+        if self.pattern.search(block) is None:
+            return block
+        return self.pattern.sub(self.replacement, block)
+
+
+class RateLimit(Stage):
+    """
+    A token bucket of rate bytes per second, holding up to burst bytes
+    (default: one second's worth). Data passes through; once the bucket
+    runs dry, delay says how long to wait before the next read.
+    """
+
+    name = "rate"
+
+    def __init__(self, rate, burst=None):
+        if not rate > 0:
+            raise ValueError("rate must be above 0 bytes per second")
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def process(self, data):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - len(data)
+        self.last = now
+        self.delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return data
+
+
+def boguscoin_rewrite():
+    return RegexRewrite(BOGUS_ADDRESS, tony_address, hint=b'7', name="boguscoin")
+
+def rate_limit(arg):
+    if arg is None:
+        raise ValueError("expected rate:BYTES_PER_SEC")
+    return RateLimit(float(arg))
+
+
+# Stages by name for --client-stages and --upstream-stages; each takes
+# the text after a ':' in the spec, or None
+STAGES = {
+    "lines": lambda arg: LineFramer(int(arg)) if arg else LineFramer(),
+    "boguscoin": lambda arg: boguscoin_rewrite(),
+    "rate": rate_limit,
+}
+DEFAULT_STAGES = "lines,boguscoin"
+# Stage specs for each direction, and the stats of every stage run so far
+client_stages = DEFAULT_STAGES
+upstream_stages = DEFAULT_STAGES
+stage_stats = {}
+
+
+def parse_stages(text):
+    """'lines,rate:1e6' -> the same spec, once every stage in it builds."""
+    for part in filter(None, text.split(',')):
+        name, _, arg = part.partition(':')
+        if name not in STAGES:
+            raise argparse.ArgumentTypeError(f"unknown stage {name!r}; stages: {', '.join(STAGES)}")
+        try:
+            STAGES[name](arg or None)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"bad stage {part!r}: {e}")
+    return text
+
+
+class Pipeline:
+    """
+    One direction of a proxied connection: a chain of stages built from
+    a spec like 'lines,boguscoin', each timed into stage_stats under
+    '<direction>.<stage name>'. Stages with the same name share stats.
+    """
+
+    def __init__(self, spec=DEFAULT_STAGES, direction="client"):
+        self.stages = []
+        self.stats = []
+        for part in filter(None, spec.split(',')):
+            name, _, arg = part.partition(':')
+            stage = STAGES[name](arg or None)
+            self.stages.append(stage)
+            self.stats.append(stage_stats.setdefault(f"{direction}.{stage.name}", StageStats()))
+
+    def feed(self, data, first=0):
+        """Runs data through the stages from first on; returns what comes out, possibly empty."""
+        for stage, stats in zip(self.stages[first:], self.stats[first:]):
+            if not data:
+                return b""
+            start = time.perf_counter_ns()
+            nbytes = len(data)
+            data = stage.process(data)
+            stats.calls += 1
+            stats.bytes_in += nbytes
+            stats.ns += time.perf_counter_ns() - start
+        return data
+
+    def recv_from(self, sock):
+        """
+        Receives once and returns what comes out of the stages (possibly
+        empty), or None at EOF. A LineFramer first in line receives into
+        its own buffer, and what it passes on is only valid until the
+        next call.
+        """
+        if not self.stages or not isinstance(self.stages[0], LineFramer):
+            data = sock.recv(READ_SIZE)
+            return self.feed(data) if data else None
+
+        framer, stats = self.stages[0], self.stats[0]
+        n = sock.recv_into(framer.reserve())
+        if n == 0:
+            return None
+        start = time.perf_counter_ns()
+        data = framer.commit(n)
+        stats.calls += 1
+        stats.bytes_in += n
+        stats.ns += time.perf_counter_ns() - start
+        return self.feed(data, 1)
+
+    def flush(self):
+        """Runs whatever each stage holds back through the ones after it, at end of stream."""
+        data = b""
+        for stage, stats in zip(self.stages, self.stats):
+            start = time.perf_counter_ns()
+            if data:
+                stats.bytes_in += len(data)
+                data = stage.process(data)
+            if tail := stage.flush():
+                data = bytes(data) + tail
+            stats.calls += 1
+            stats.ns += time.perf_counter_ns() - start
+        return data
+
+    def take_delay(self):
+        """The longest wait any stage asked for since the last call, in seconds."""
+        delay = 0.0
+        for stage in self.stages:
+            delay = max(delay, stage.delay)
+            stage.delay = 0.0
+        return delay
+
+
+def stage_snapshot():
+    """stage_stats as plain dicts, slowest stage first."""
+    stages = sorted(list(stage_stats.items()), key=lambda item: item[1].ns, reverse=True)
+    return {label: stage.snapshot() for label, stage in stages}
+
+
+class Upstream:
+    """
+    One upstream chat server: how many proxied connections it carries,
+    and a pool of idle connections dialed ahead of time. The pool holds
+    sockets (threads) or (reader, writer) pairs (asyncio); every take
+    sets wanted, and a refill worker tops the pool back up to POOL_SIZE.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.active = 0
+        self.idle = collections.deque()
+        self.wanted = None
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    def connect(self):
+        """A connected socket: a pooled one that is still open, or a fresh one."""
+        if self.wanted is not None:
+            self.wanted.set()
+        while True:
+            try:
+                sock = self.idle.popleft()
+            except IndexError:
+                return socket.create_connection((self.host, self.port))
+            if is_open(sock):
+                return sock
+            sock.close()
+
+    def refill(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            while len(self.idle) < POOL_SIZE:
+                try:
+                    self.idle.append(socket.create_connection((self.host, self.port)))
+                except OSError as e:
+                    print(f"Pool can't reach {self}: {e}")
+                    time.sleep(POOL_RETRY)
+
+    async def open_connection(self):
+        """A (reader, writer) pair: a pooled one that is still open, or a fresh one."""
+        if self.wanted is not None:
+            self.wanted.set()
+        while self.idle:
+            reader, writer = self.idle.popleft()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def refill_async(self):
+        while True:
+            await self.wanted.wait()
+            self.wanted.clear()
+            while len(self.idle) < POOL_SIZE:
+                try:
+                    self.idle.append(await asyncio.open_connection(self.host, self.port))
+                except OSError as e:
+                    print(f"Pool can't reach {self}: {e}")
+                    await asyncio.sleep(POOL_RETRY)
+
+
+def is_open(sock):
+    """Whether an idle socket's peer is still there, without reading from it."""
+    try:
+        return bool(sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+def parse_upstream(text):
+    """'host:port' -> Upstream"""
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {text!r}")
+    return Upstream(host, int(port))
+
+def choose_upstream():
+    if upstream_policy == "least-connections":
+        return min(upstreams, key=lambda upstream: upstream.active)
+    return upstreams[next(upstream_turn) % len(upstreams)]
+
 
 def connect_to_upstream(conn):
+    upstream = choose_upstream()
+    with active_lock:
+        upstream.active += 1
     try:
-        with socket.create_connection((UPSTREAM_HOST, UPSTREAM_PORT)) as upstream_sock:
-            print(f"Connected to {UPSTREAM_HOST}:{UPSTREAM_PORT}")
+        with upstream.connect() as upstream_sock:
+            print(f"Connected to {upstream}")
             
-            def forward_data(source, destination, name):
+            def forward_data(source, destination, name, stages):
+                pipeline = Pipeline(stages, name.lower())
                 try:
                     while True:
-                        data = source.recv(4096)
-                        if not data:
+                        data = pipeline.recv_from(source)
+                        if data is None:
                             print(f"{name} closed the connection.")
+                            destination.sendall(pipeline.flush())
+                            # Pass the half-close on; the other direction keeps flowing
+                            destination.shutdown(socket.SHUT_WR)
                             break
-                        
-                        if data.find(b'7') >= 0:
-                            indx = data.find(b'7')
-                            
-                            end_markers = [b' ', b'\n', b'\r', b'\t']
-                            end_idx = len(data)
-                            for marker in end_markers:
-                                marker_pos = data.find(marker, indx)
-                                if marker_pos != -1:
-                                    end_idx = min(end_idx, marker_pos)
-                            
-                            address = data[indx:end_idx]
-                            
-                            try:
-                                address_str = address.decode('utf-8')
-                                if is_bogus_address(address_str):
-                                    data = data[:indx] + tony_address + data[end_idx:]
-                            except UnicodeDecodeError:
-                                pass
-                        
-                        try:
+                        if data:
                             destination.sendall(data)
-                        except Exception as send_error:
-                            break
+                        if delay := pipeline.take_delay():
+                            time.sleep(delay)
                 except Exception as e:
                     print(f"Error in {name}:", e)
-                finally:
-                    try:
-                        source.close()
-                    except:
-                        pass
-                    try:
-                        destination.close()
-                    except:
-                        pass
+                    # close() wouldn't wake the other thread's recv(); shutdown() does
+                    for sock in (source, destination):
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
             
             client_to_upstream = threading.Thread(
                 target=forward_data,
-                args=(conn, upstream_sock, "Client")
+                args=(conn, upstream_sock, "Client", client_stages)
             )
             upstream_to_client = threading.Thread(
                 target=forward_data,
-                args=(upstream_sock, conn, "Upstream")
+                args=(upstream_sock, conn, "Upstream", upstream_stages)
             )
             
             client_to_upstream.start()
@@ -73,23 +473,13 @@ def connect_to_upstream(conn):
     except Exception as e:
         print("Error in proxying:", e)
     finally:
+        with active_lock:
+            upstream.active -= 1
         try:
             conn.close()
         except:
             pass
 
-def is_bogus_address(address):
-    if not address:
-        return False
-    if not address[0] == '7':
-        return False
-    if len(address) < 26 or len(address) > 35:
-        return False
-    if not address.isalnum():
-        return False 
-        
-    return True
-
 def handle_client(conn, addr):
     print(f"Connected by {addr}")
     try:
@@ -104,6 +494,14 @@ def handle_client(conn, addr):
             pass
 
 def start_server():
+    if POOL_SIZE:
+        for upstream in upstreams:
+            upstream.wanted = threading.Event()
+            upstream.wanted.set()
+            threading.Thread(target=upstream.refill, daemon=True).start()
+    if STATS_PORT:
+        threading.Thread(target=common.serve_stats, args=(HOST, STATS_PORT, stage_snapshot),
+                         daemon=True).start()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((HOST, PORT))
@@ -115,5 +513,115 @@ def start_server():
             thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
             thread.start()
 
+async def pipe(reader, writer, name, stages):
+    """
+    Copies one direction of a proxied connection through its stages,
+    and waits for the other end to drain before reading more. At EOF the
+    half-close is passed on; the other direction keeps flowing.
+    """
+    pipeline = Pipeline(stages, name.lower())
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            break
+        data = pipeline.feed(data)
+        if data:
+            writer.write(data)
+            await writer.drain()
+        if delay := pipeline.take_delay():
+            await asyncio.sleep(delay)
+    print(f"{name} closed the connection.")
+    writer.write(pipeline.flush())
+    if writer.can_write_eof():
+        writer.write_eof()
+    await writer.drain()
+
+async def handle_client_async(client_reader, client_writer):
+    addr = client_writer.get_extra_info('peername')
+    print(f"Connected by {addr}")
+    upstream = choose_upstream()
+    upstream.active += 1
+    upstream_writer = None
+    try:
+        upstream_reader, upstream_writer = await upstream.open_connection()
+        print(f"Connected to {upstream}")
+        pipes = [
+            asyncio.create_task(pipe(client_reader, upstream_writer, "Client", client_stages)),
+            asyncio.create_task(pipe(upstream_reader, client_writer, "Upstream", upstream_stages)),
+        ]
+        try:
+            await asyncio.gather(*pipes)
+        finally:
+            # A failure in one direction ends the other too
+            for task in pipes:
+                task.cancel()
+    except (OSError, ValueError) as e:
+        print(f"Error with {addr}: {e}")
+    finally:
+        upstream.active -= 1
+        client_writer.close()
+        if upstream_writer is not None:
+            upstream_writer.close()
+        print(f"Disconnected by {addr}")
+
+async def start_async_server():
+    refills = []
+    if POOL_SIZE:
+        for upstream in upstreams:
+            upstream.wanted = asyncio.Event()
+            upstream.wanted.set()
+            refills.append(asyncio.create_task(upstream.refill_async()))
+    stats_server = None
+    if STATS_PORT:
+        stats_server = await common.start_stats_server(HOST, STATS_PORT, stage_snapshot)
+    server = await asyncio.start_server(handle_client_async, HOST, PORT, reuse_address=True)
+    print(f"Server listening on {HOST}:{PORT} (asyncio)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if stats_server is not None:
+            stats_server.close()
+
+
+def main():
+    global PORT, upstreams, upstream_policy, POOL_SIZE, client_stages, upstream_stages, STATS_PORT
+
+    parser = argparse.ArgumentParser(description="Mob in the Middle proxy")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="proxy with asyncio instead of three threads per client")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--upstream", type=parse_upstream, action="append",
+                        help=f"HOST:PORT of an upstream chat server; repeat for several "
+                             f"(default: {UPSTREAM_HOST}:{UPSTREAM_PORT})")
+    parser.add_argument("--balance", choices=UPSTREAM_POLICIES, default=upstream_policy,
+                        help="how each client is given one of several upstreams")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="idle upstream connections to keep dialed ahead, per upstream")
+    parser.add_argument("--client-stages", type=parse_stages, default=client_stages,
+                        help=f"comma-separated stages for client -> upstream traffic, "
+                             f"e.g. lines,boguscoin,rate:100000 (stages: {', '.join(STAGES)})")
+    parser.add_argument("--upstream-stages", type=parse_stages, default=upstream_stages,
+                        help="comma-separated stages for upstream -> client traffic")
+    parser.add_argument("--stats-port", type=int, default=STATS_PORT,
+                        help="serve per-stage timings on this port (0: off)")
+    args = parser.parse_args()
+
+    PORT = args.port
+    upstreams = args.upstream or [Upstream(UPSTREAM_HOST, UPSTREAM_PORT)]
+    upstream_policy = args.balance
+    POOL_SIZE = args.pool_size
+    client_stages = args.client_stages
+    upstream_stages = args.upstream_stages
+    STATS_PORT = args.stats_port
+    if args.use_async:
+        try:
+            asyncio.run(start_async_server())
+        except KeyboardInterrupt:
+            pass
+    else:
+        start_server()
+
+
 if __name__ == '__main__':
-    start_server()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,325 @@
+import asyncio
+import multiprocessing
+import random
+import socket
+import string
+import threading
+import time
+
+import common
+import mob
+
+# Roughly this much chat traffic per run
+TRAFFIC_BYTES = 20_000_000
+CHUNK_SIZES = [4096, 65536]
+# One line in this many carries an address, for the "addresses" workload
+ADDRESS_EVERY = 20
+# Connection setup runs: a local upstream stub that greets after each delay
+STUB_PORT = 65492
+PROXY_PORT = 65491
+GREETING_DELAYS = [0.0, 0.02]
+CONNECTIONS = 100
+# Pause between connections, so a pool has time to refill
+CONNECT_INTERVAL = 0.01
+PROXY_MODES = {
+    "threads": [],
+    "threads, pool": ["--pool-size", "4"],
+    "asyncio": ["--async"],
+    "asyncio, pool": ["--async", "--pool-size", "4"],
+}
+WORDS = ["hello", "anyone", "here", "payment", "send", "to", "the", "room", "ok", "thanks",
+         "what", "is", "up", "7", "700", "address"]
+
+
+def make_address(rng):
+    alphabet = string.ascii_letters + string.digits
+    return "7" + "".join(rng.choices(alphabet, k=rng.randrange(25, 35)))
+
+
+def make_traffic(size, address_every, seed=0):
+    """Returns (chat lines as bytes, number of addresses in them)."""
+    rng = random.Random(seed)
+    lines = []
+    addresses = total = 0
+    while total < size:
+        words = rng.choices(WORDS, k=rng.randrange(3, 15))
+        if address_every and rng.randrange(address_every) == 0:
+            words.insert(rng.randrange(len(words) + 1), make_address(rng))
+            addresses += 1
+        line = f"[user{rng.randrange(100)}] {' '.join(words)}\n".encode()
+        lines.append(line)
+        total += len(line)
+    return b"".join(lines), addresses
+
+
+def forward_plain(chunks):
+    """Plain byte forwarding: every chunk goes out as it came in."""
+    return chunks
+
+
+def forward_first_per_chunk(chunks):
+    """What forward_data used to do: rewrite at most the first '7' word of each recv() chunk."""
+    for data in chunks:
+        if data.find(b'7') >= 0:
+            indx = data.find(b'7')
+            end_idx = len(data)
+            for marker in [b' ', b'\n', b'\r', b'\t']:
+                marker_pos = data.find(marker, indx)
+                if marker_pos != -1:
+                    end_idx = min(end_idx, marker_pos)
+            address = data[indx:end_idx].decode('utf-8', 'replace')
+            if 26 <= len(address) <= 35 and address.isalnum():
+                data = data[:indx] + mob.tony_address + data[end_idx:]
+        yield data
+
+
+def forward_pipeline(chunks):
+    pipeline = mob.Pipeline()
+    for data in chunks:
+        yield pipeline.feed(data)
+    yield pipeline.flush()
+
+
+FORWARDERS = {
+    "plain": forward_plain,
+    "first per chunk": forward_first_per_chunk,
+    "pipeline": forward_pipeline,
+}
+
+
+def drain(sock, received):
+    """Reads sock to EOF into received."""
+    while data := sock.recv(1 << 20):
+        received += data
+
+
+def run_forwarder(forwarder, chunks):
+    """
+    Sends what forwarder makes of chunks through a socket pair, as the
+    proxy would. Returns (seconds, every byte received at the far end).
+    """
+    sender, receiver = socket.socketpair()
+    received = bytearray()
+    reader = threading.Thread(target=drain, args=(receiver, received))
+    reader.start()
+    start = time.perf_counter()
+    for data in forwarder(chunks):
+        if data:
+            sender.sendall(data)
+    sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return elapsed, received
+
+
+def bench_rewrite(size=TRAFFIC_BYTES):
+    """
+    Throughput of each forwarder into a socket, and how many addresses
+    each really rewrote.
+    """
+    print(f"{'workload':>10} {'chunk':>6} {'forwarder':>16} {'MB/s':>8} {'vs plain':>9} {'rewritten':>15}")
+    for workload, address_every in (("no addrs", 0), ("addresses", ADDRESS_EVERY)):
+        traffic, addresses = make_traffic(size, address_every)
+        for chunk_size in CHUNK_SIZES:
+            chunks = [traffic[i:i + chunk_size] for i in range(0, len(traffic), chunk_size)]
+            plain = None
+            for name, forwarder in FORWARDERS.items():
+                elapsed, received = run_forwarder(forwarder, chunks)
+                if plain is None:
+                    plain = elapsed
+                rewritten = received.count(mob.tony_address)
+                print(f"{workload:>10} {chunk_size:>6} {name:>16} {len(traffic) / elapsed / 1e6:>8.0f} "
+                      f"{elapsed / plain:>8.1f}x {rewritten:>7,}/{addresses:<7,}")
+
+
+async def greet(reader, writer, delay):
+    """The stub's client handler: greets after delay, then reads to EOF."""
+    await asyncio.sleep(delay)
+    writer.write(b"Welcome to budgetchat! What shall I call you?\n")
+    try:
+        while await reader.read(65536):
+            pass
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def serve_stub(port, delay):
+    server = await asyncio.start_server(lambda r, w: greet(r, w, delay), "127.0.0.1", port,
+                                        reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+def run_stub(port, delay):
+    """
+    A stand-in upstream whose greeting takes delay seconds, like a
+    chat server some way off.
+    """
+    asyncio.run(serve_stub(port, delay))
+
+
+def time_to_first_byte(port, connections=CONNECTIONS, interval=CONNECT_INTERVAL):
+    """Sorted seconds from connect() to the first byte, one connection at a time."""
+    times = []
+    for _ in range(connections):
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.recv(1)
+            times.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return sorted(times)
+
+
+def bench_setup():
+    """Time to first byte through the proxy, dialing on accept or taking from a pool."""
+    print(f"\nconnection setup, {CONNECTIONS} connections one at a time")
+    print(f"{'greeting':>9} {'proxy':>14} {'p50':>9} {'p99':>9}")
+    for delay in GREETING_DELAYS:
+        stub = multiprocessing.Process(target=run_stub, args=(STUB_PORT, delay), daemon=True)
+        stub.start()
+        try:
+            common.wait_for_port(STUB_PORT)
+            for label, args in PROXY_MODES.items():
+                proxy = common.start_process("mob.py", *args, "--port", str(PROXY_PORT),
+                                             "--upstream", f"127.0.0.1:{STUB_PORT}", port=PROXY_PORT)
+                try:
+                    time.sleep(CONNECT_INTERVAL)  # let the pool refill after the port check
+                    times = time_to_first_byte(PROXY_PORT)
+                finally:
+                    common.stop_process(proxy)
+                p50 = common.percentile(times, 0.5)
+                p99 = common.percentile(times, 0.99)
+                print(f"{delay * 1e3:>7.0f}ms {label:>14} {p50 * 1e3:>7.2f}ms {p99 * 1e3:>7.2f}ms")
+        finally:
+            stub.terminate()
+            stub.join()
+
+
+def loop_plain(source, destination):
+    """Forwarding with no rewriting at all, a fresh bytes per read."""
+    while data := source.recv(mob.READ_SIZE):
+        destination.sendall(data)
+
+
+def loop_plain_into(source, destination):
+    """Forwarding with no rewriting, into one reused buffer: the floor."""
+    buf = bytearray(mob.READ_SIZE)
+    view = memoryview(buf)
+    while n := source.recv_into(buf):
+        destination.sendall(view[:n])
+
+
+def loop_feed(source, destination, stages=mob.DEFAULT_STAGES):
+    """recv() then Pipeline.feed(): a fresh bytes per read, as the asyncio pipes do."""
+    pipeline = mob.Pipeline(stages)
+    while data := source.recv(mob.READ_SIZE):
+        if data := pipeline.feed(data):
+            destination.sendall(data)
+    destination.sendall(pipeline.flush())
+
+
+def loop_recv_from(source, destination, stages=mob.DEFAULT_STAGES):
+    """Pipeline.recv_from(), as forward_data does."""
+    pipeline = mob.Pipeline(stages)
+    while (data := pipeline.recv_from(source)) is not None:
+        if data:
+            destination.sendall(data)
+    destination.sendall(pipeline.flush())
+
+
+PASSTHROUGH_LOOPS = {
+    "plain recv": loop_plain,
+    "plain recv_into": loop_plain_into,
+    "recv + feed": loop_feed,
+    "recv_from": loop_recv_from,
+}
+
+
+def run_passthrough(loop, chunks):
+    """
+    Feeds chunks into one socket pair, runs loop from it into another,
+    as the proxy's forwarding thread, and drains the far end. Returns
+    (seconds, bytes received).
+    """
+    source, feed_end = socket.socketpair()
+    destination, far_end = socket.socketpair()
+
+    def feed():
+        for chunk in chunks:
+            feed_end.sendall(chunk)
+        feed_end.shutdown(socket.SHUT_WR)
+
+    def forward():
+        loop(source, destination)
+        destination.shutdown(socket.SHUT_WR)
+
+    threads = [threading.Thread(target=feed), threading.Thread(target=forward)]
+    buf = bytearray(1 << 20)
+    received = 0
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while n := far_end.recv_into(buf):
+        received += n
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    for sock in (source, feed_end, destination, far_end):
+        sock.close()
+    return elapsed, received
+
+
+def bench_passthrough(size=TRAFFIC_BYTES, runs=3):
+    """Bytes/sec through a forwarding thread, with and without a '7' in the traffic."""
+    print(f"\nforwarding thread, {size / 1e6:.0f} MB fed in 64 KiB writes, best of {runs}")
+    print(f"{'workload':>10} {'loop':>16} {'MB/s':>8}")
+    traffic, _ = make_traffic(size, ADDRESS_EVERY)
+    workloads = (("no '7'", traffic.replace(b"7", b"8")), ("addresses", traffic))
+    for workload, data in workloads:
+        chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+        for name, loop in PASSTHROUGH_LOOPS.items():
+            best = float("inf")
+            for _ in range(runs):
+                elapsed, received = run_passthrough(loop, chunks)
+                best = min(best, elapsed)
+            if name.startswith("plain") or workload != "addresses":
+                assert received == len(data), f"{name}: {received} of {len(data)} bytes"
+            print(f"{workload:>10} {name:>16} {len(data) / best / 1e6:>8.0f}")
+
+
+# Stage chains for the stages bench; the rate limit is set too high to ever wait
+STAGE_SPECS = ["", "lines", "lines,boguscoin", "lines,boguscoin,rate:1e12"]
+
+
+def bench_stages(size=TRAFFIC_BYTES):
+    """
+    Throughput through a forwarding thread for longer stage chains, and
+    what each stage's timing counters say it cost.
+    """
+    print(f"\nstage chains, {size / 1e6:.0f} MB through a forwarding thread")
+    print(f"{'workload':>10} {'stages':>26} {'MB/s':>8}  ns/byte per stage")
+    traffic, _ = make_traffic(size, ADDRESS_EVERY)
+    for workload, data in (("no '7'", traffic.replace(b"7", b"8")), ("addresses", traffic)):
+        chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+        for spec in STAGE_SPECS:
+            mob.stage_stats.clear()
+            elapsed, _ = run_passthrough(lambda source, destination: loop_recv_from(source, destination, spec),
+                                         chunks)
+            costs = "  ".join(f"{label.split('.', 1)[1]} {stage.ns / stage.bytes_in:.3f}"
+                              for label, stage in mob.stage_stats.items())
+            print(f"{workload:>10} {spec or '(none)':>26} {len(data) / elapsed / 1e6:>8.0f}  {costs}")
+
+
+BENCHES = {
+    "rewrite": bench_rewrite,
+    "setup": bench_setup,
+    "passthrough": bench_passthrough,
+    "stages": bench_stages,
+}
+
+if __name__ == "__main__":
+    for name in common.parse_names("Mob in the Middle benchmarks", BENCHES, "BENCH", "benches to run"):
+        BENCHES[name]()
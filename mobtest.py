@@ -0,0 +1,260 @@
+import importlib
+import json
+import socket
+import time
+
+import common
+
+kvtest = importlib.import_module("4test")
+
+HOST = "127.0.0.1"
+# chat.py stands in for chat.protohackers.com
+CHAT_PORT = 65495
+PROXY_PORT = 65494
+# A second chat.py for the balancing tests
+OTHER_CHAT_PORT = 65493
+STATS_PORT = 65490
+TONY = b"7YWHMfk9JZe0LM0g1ZauHuiSxhI"
+ADDRESSES = [b"7F1u3wSD5RbOHQmupo9nx4TnhQ", b"7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX",
+             b"7LOrwbDlS8NujgjddyogWgIM93MV5N2VR"]
+MANY_CLIENTS = 300
+MODES = {
+    "threads": [],
+    "async": ["--async"],
+    "threads-pool": ["--pool-size", "4"],
+    "async-pool": ["--async", "--pool-size", "4"],
+}
+# The asyncio proxy must not grow threads with its clients
+ASYNC_MAX_THREADS = 4
+
+
+class ChatUser:
+    """A Budget Chat user on a socket, read line by line."""
+
+    def __init__(self, port, name, timeout=2.0):
+        self.sock = socket.create_connection((HOST, port))
+        self.sock.settimeout(timeout)
+        self.buffer = b""
+        self.expect(b"What shall I call you?")
+        self.sock.sendall(name + b"\n")
+        self.listing = self.expect(b"* ")
+
+    def readline(self):
+        while b"\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError("connection closed")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    def expect(self, text):
+        """Reads lines until one contains text; returns it."""
+        while True:
+            line = self.readline()
+            if text in line:
+                return line
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def proxied(name, room):
+    return ChatUser(PROXY_PORT, name + b"@" + room)
+
+def direct(name, room):
+    return ChatUser(CHAT_PORT, name + b"@" + room)
+
+
+def test_join_through_proxy():
+    alice = proxied(b"alice", b"join")
+    bob = proxied(b"bob", b"join")
+    line = alice.expect(b"bob has entered")
+    assert line == b"* bob has entered the room", f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_rewrite_client_to_upstream():
+    alice = proxied(b"alice", b"outbound")
+    bob = direct(b"bob", b"outbound")
+    alice.send(b"Send to " + ADDRESSES[0] + b" please\n")
+    line = bob.expect(b"[alice]")
+    assert line == b"[alice] Send to " + TONY + b" please", f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_rewrite_upstream_to_client():
+    alice = proxied(b"alice", b"inbound")
+    bob = direct(b"bob", b"inbound")
+    bob.send(ADDRESSES[1] + b"\n")
+    line = alice.expect(b"[bob]")
+    assert line == b"[bob] " + TONY, f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_every_address_in_a_message():
+    alice = proxied(b"alice", b"many")
+    bob = direct(b"bob", b"many")
+    alice.send(b" ".join(ADDRESSES) + b"\n" + ADDRESSES[0] + b" and " + ADDRESSES[2] + b"\n")
+    first, second = bob.expect(b"[alice]"), bob.expect(b"[alice]")
+    assert first == b"[alice] " + b" ".join([TONY] * 3), f"Got {first!r}"
+    assert second == b"[alice] " + TONY + b" and " + TONY, f"Got {second!r}"
+    alice.close()
+    bob.close()
+
+def test_address_split_across_segments():
+    alice = proxied(b"alice", b"split")
+    bob = direct(b"bob", b"split")
+    message = b"pay " + ADDRESSES[2] + b" now\n"
+    for i in range(0, len(message), 3):
+        alice.send(message[i:i + 3])
+        time.sleep(0.01)
+    line = bob.expect(b"[alice]")
+    assert line == b"[alice] pay " + TONY + b" now", f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_lookalikes_untouched():
+    alice = proxied(b"alice", b"lookalike")
+    bob = direct(b"bob", b"lookalike")
+    lookalikes = [b"7abc", ADDRESSES[0] + b"x" * 20, ADDRESSES[0] + b"-x", b"x" + ADDRESSES[0]]
+    alice.send(b" ".join(lookalikes) + b"\n")
+    line = bob.expect(b"[alice]")
+    assert line == b"[alice] " + b" ".join(lookalikes), f"Got {line!r}"
+    alice.close()
+    bob.close()
+
+def test_half_close():
+    """A client that sends and half-closes still gets its message through, then EOF."""
+    alice = proxied(b"alice", b"halfclose")
+    bob = direct(b"bob", b"halfclose")
+    alice.send(b"bye " + ADDRESSES[1] + b"\n")
+    alice.sock.shutdown(socket.SHUT_WR)
+    line = bob.expect(b"[alice]")
+    assert line == b"[alice] bye " + TONY, f"Got {line!r}"
+    bob.expect(b"alice has left")
+    try:
+        while True:
+            alice.readline()
+    except EOFError:
+        pass
+    alice.close()
+    bob.close()
+
+def test_stage_stats():
+    """The stats port has timings for both directions' stages, after traffic went through them."""
+    alice = proxied(b"alice", b"stats")
+    bob = direct(b"bob", b"stats")
+    alice.send(ADDRESSES[0] + b"\n")
+    bob.expect(b"[alice]")
+    alice.close()
+    bob.close()
+    with socket.create_connection((HOST, STATS_PORT)) as sock:
+        sock.sendall(b"json\n")
+        reply = b""
+        while data := sock.recv(65536):
+            reply += data
+    stats = json.loads(reply)
+    for label in ("client.lines", "client.boguscoin", "upstream.lines", "upstream.boguscoin"):
+        assert stats.get(label, {}).get("calls", 0) > 0, f"No calls for {label}: {stats}"
+
+def proxy_threads(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return 0
+
+def make_many_clients_test(proxy, max_threads=None):
+    def test_many_clients():
+        users = [proxied(b"user%d" % i, b"crowd") for i in range(MANY_CLIENTS)]
+        threads = proxy_threads(proxy.pid)
+        users[0].send(ADDRESSES[0] + b"\n")
+        line = users[-1].expect(b"[user0]")
+        for user in users:
+            user.close()
+        print(f"    {MANY_CLIENTS} clients, proxy threads: {threads}")
+        assert line == b"[user0] " + TONY, f"Got {line!r}"
+        assert max_threads is None or threads <= max_threads, f"{threads} threads"
+    return test_many_clients
+
+
+def test_round_robin():
+    """Two clients in a row land on different upstreams, so neither sees the other."""
+    alice = proxied(b"alice", b"balance")
+    bob = proxied(b"bob", b"balance")
+    for user in (alice, bob):
+        assert user.listing == b"* There is nobody in the room", f"Got {user.listing!r}"
+    alice.close()
+    bob.close()
+
+def test_least_connections():
+    """Once bob leaves his upstream, carol goes there too, not next in turn to alice's."""
+    alice = proxied(b"alice", b"least")
+    bob = proxied(b"bob", b"least")
+    bob.close()
+    time.sleep(0.2)
+    carol = proxied(b"carol", b"least")
+    assert carol.listing == b"* There is nobody in the room", f"Got {carol.listing!r}"
+    alice.close()
+    carol.close()
+
+
+def run_tests(mode):
+    """Runs every test through mob.py in the given mode, with chat.py as the upstream."""
+    print(f"🚀 Starting Mob in the Middle Tests ({mode})\n")
+    chat = common.start_process("chat.py", "--async", "--port", str(CHAT_PORT), port=CHAT_PORT)
+    proxy = common.start_process("mob.py", *MODES[mode], "--port", str(PROXY_PORT),
+                                 "--upstream", f"{HOST}:{CHAT_PORT}", "--stats-port", str(STATS_PORT),
+                                 port=PROXY_PORT)
+    try:
+        runner = kvtest.TestRunner()
+        test_cases = [
+            ("Join through the proxy", test_join_through_proxy),
+            ("Rewrite client -> upstream", test_rewrite_client_to_upstream),
+            ("Rewrite upstream -> client", test_rewrite_upstream_to_client),
+            ("Rewrite every address in a message", test_every_address_in_a_message),
+            ("Address split across segments", test_address_split_across_segments),
+            ("Lookalikes left alone", test_lookalikes_untouched),
+            ("Half-close", test_half_close),
+            ("Stage timings", test_stage_stats),
+            (f"{MANY_CLIENTS} concurrent clients",
+             make_many_clients_test(proxy, ASYNC_MAX_THREADS if mode.startswith("async") else None)),
+        ]
+        for test_name, test_func in test_cases:
+            runner.test(test_name, test_func)
+        return runner.print_summary()
+    finally:
+        common.stop_process(proxy)
+        common.stop_process(chat)
+
+def run_balance_tests():
+    """Runs the asyncio proxy in front of two chat.py upstreams with each policy."""
+    print("🚀 Starting Mob in the Middle Tests (two upstreams)\n")
+    chats = [common.start_process("chat.py", "--async", "--port", str(port), port=port)
+             for port in (CHAT_PORT, OTHER_CHAT_PORT)]
+    runner = kvtest.TestRunner()
+    try:
+        for policy, test_func in (("round-robin", test_round_robin),
+                                  ("least-connections", test_least_connections)):
+            proxy = common.start_process("mob.py", "--async", "--port", str(PROXY_PORT), "--balance", policy,
+                                         "--upstream", f"{HOST}:{CHAT_PORT}",
+                                         "--upstream", f"{HOST}:{OTHER_CHAT_PORT}", port=PROXY_PORT)
+            try:
+                runner.test(policy, test_func)
+            finally:
+                common.stop_process(proxy)
+        return runner.print_summary()
+    finally:
+        for chat in chats:
+            common.stop_process(chat)
+
+
+if __name__ == "__main__":
+    modes = common.parse_names("Tests for mob.py against a local chat.py", [*MODES, "balance"],
+                               "MODE", "proxy modes to test")
+    results = [run_balance_tests() if mode == "balance" else run_tests(mode) for mode in modes]
+    exit(0 if all(results) else 1)